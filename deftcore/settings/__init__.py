@@ -87,6 +87,12 @@ STATIC_ROOT = 'static'
 
 DATABASE_ROUTERS = ['deftcore.routers.DefaultRouter']
 
+# keep database connections open between API requests (seconds), unless set in private settings
+DATABASE_CONN_MAX_AGE = 60
+
+for database_config in DATABASES.values():
+    database_config.setdefault('CONN_MAX_AGE', DATABASE_CONN_MAX_AGE)
+
 LOGGING_BASE_DIR = os.path.join(BASE_DIR, '../../logs')
 
 if DEBUG:
@@ -217,6 +223,8 @@ MONITORING_REQUEST_LINK_FORMAT = 'https://prodtask-dev.cern.ch/prodtask/inputlis
 
 REQUEST_GRACE_PERIOD = 1
 
+BULK_CREATE_BATCH_SIZE = 100
+
 
 # 61013 (STOMP) and 61023 (STOMP over SSL, with X.509 authentication)
 class MessagingConfig:
@@ -31,6 +31,20 @@ def prefetch_id(db, seq_name):
     return new_id
 
 
+def prefetch_ids(db, seq_name, count):
+    new_ids = list()
+    cursor = connections[db].cursor()
+    try:
+        query = 'select {0}.nextval from dual connect by level <= %s'.format(seq_name)
+        cursor.execute(query, [count])
+        rows = cursor.fetchall()
+        new_ids = [row[0] for row in rows]
+    finally:
+        if cursor:
+            cursor.close()
+    return new_ids
+
+
 class TRequest(models.Model):
     id = models.DecimalField(decimal_places=0, max_digits=12, db_column='PR_ID', primary_key=True)
     manager = models.CharField(max_length=32, db_column='MANAGER', null=False)
@@ -412,6 +426,9 @@ class TTask(models.Model):
     def get_id(self):
         return prefetch_id(self._meta.db_name, 'ATLAS_DEFT.PRODSYS2_TASK_ID_SEQ')
 
+    def get_ids(self, count):
+        return prefetch_ids(self._meta.db_name, 'ATLAS_DEFT.PRODSYS2_TASK_ID_SEQ', count)
+
     def save(self, *args, **kwargs):
         if not self.id:
             self.id = self.get_id()
@@ -433,8 +450,9 @@ class TTask(models.Model):
                 return dataset
         return
 
-    def get_job_parameter(self, value, parameter_key):
-        params = self._get_task_params()
+    def get_job_parameter(self, value, parameter_key, params=None):
+        if params is None:
+            params = self._get_task_params()
         job_params = params.get('jobParameters')
         if not job_params:
             return None
@@ -12,6 +12,11 @@ from taskengine.protocol import TaskDefConstants
 from deftcore.log import Logger
 
 logger = Logger.get()
+
+_BOOL_OPTION_VALUES = {'yes': True, 'no': False}
+_UNSET = object()
+
+
 class UnknownProjectModeOption(Exception):
     def __init__(self, option_key):
         super(UnknownProjectModeOption, self).__init__('Invalid project_mode option: {0}'.format(option_key))
@@ -24,6 +29,8 @@ class InvalidProjectModeOptionValue(Exception):
 
 
 class ProjectMode(object):
+    _option_names = None
+
     def __init__(self, step, cache=None, use_nightly_release=False):
         """
         :param step: object of StepExecution
@@ -40,24 +47,22 @@ class ProjectMode(object):
         if 'project_mode' in list(self.task_config.keys()):
             project_mode.update(self._parse_project_mode(self.task_config['project_mode']))
 
-        project_mode_options = self.get_options()
+        option_names = self._get_option_names()
 
-        option_names = {key.lower(): key for key in list(project_mode_options.keys())}
-
-        for key in list(project_mode.keys()):
-            if key not in list(option_names.keys()):
+        for key, option_value in project_mode.items():
+            if key not in option_names:
                 raise UnknownProjectModeOption(key)
-            option_type = locate(project_mode_options[option_names[key]]['type'])
-            option_value = project_mode[key]
+            option_name, option_type = option_names[key]
             if option_type == bool:
-                if option_value == 'yes':
-                    option_value = True
-                elif option_value == 'no':
-                    option_value = False
-                else:
-                    raise InvalidProjectModeOptionValue(option_names[key], option_value)
-            setattr(self, option_names[key], option_type(option_value))
-            self.project_mode_dict.update({option_names[key]: option_type(option_value)})
+                bool_value = _BOOL_OPTION_VALUES.get(option_value, _UNSET)
+                if bool_value is _UNSET:
+                    bool_value = _BOOL_OPTION_VALUES.get(option_value.casefold(), _UNSET)
+                    if bool_value is _UNSET:
+                        raise InvalidProjectModeOptionValue(option_name, option_value)
+                option_value = bool_value
+            option_value = option_type(option_value)
+            setattr(self, option_name, option_value)
+            self.project_mode_dict[option_name] = option_value
         self._cmt_config_list = []
         self._multiple_cmtconfig = False
         if self.cmtconfig and (',' in self.cmtconfig or '|' in self.cmtconfig):
@@ -75,6 +80,14 @@ class ProjectMode(object):
         with open(path, 'r') as fp:
             return json.loads(fp.read())
 
+    @classmethod
+    def _get_option_names(cls):
+        # case-folded option name -> (option name, option type), built once per process
+        if cls._option_names is None:
+            cls._option_names = {key.casefold(): (key, locate(value['type']))
+                                 for key, value in cls.get_options().items()}
+        return cls._option_names
+
     @staticmethod
     def get_task_config(step):
         task_config = dict()
@@ -109,7 +122,7 @@ class ProjectMode(object):
             if '=' not in option:
                 raise Exception('The project_mode option \"{0}\" has invalid format. '.format(option) +
                                 'Expected format is \"optionName=optionValue\"')
-            project_mode_dict.update({option.split('=')[0].lower(): option[option.find('=')+1:]})
+            project_mode_dict.update({option.split('=')[0].casefold(): option[option.find('=')+1:]})
         return project_mode_dict
 
     def _is_cmtconfig_exist(self, cache, cmtconfig):
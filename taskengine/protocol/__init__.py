@@ -13,6 +13,9 @@ from deftcore.log import Logger
 logger = Logger.get()
 register = template.Library()
 
+_PILEUP_INPUT_PARAM_RE = re.compile(r'^.*(PtMinbias|Cavern).*File.*$', re.IGNORECASE)
+_JOB_SPLITTING_TASK_PARAMS = frozenset(('neventsperjob', 'nfilesperjob'))
+
 
 @register.filter(is_safe=True)
 @stringfilter
@@ -396,17 +399,13 @@ class Protocol(object):
 
     @staticmethod
     def is_dynamic_jobdef_enabled(task):
-        keys = [k.lower() for k in list(task.keys())]
-        if 'nEventsPerJob'.lower() in keys or 'nFilesPerJob'.lower() in keys:
-            return False
-        else:
-            return True
+        return not any(key.lower() in _JOB_SPLITTING_TASK_PARAMS for key in task)
 
     @staticmethod
     def is_pileup_task(task):
         job_params = task['jobParameters']
         for job_param in job_params:
-            if re.match(r'^.*(PtMinbias|Cavern).*File.*$', str(job_param['value']), re.IGNORECASE):
+            if _PILEUP_INPUT_PARAM_RE.match(str(job_param['value'])):
                 return True
         return False
 
@@ -2,7 +2,6 @@ __author__ = 'Dmitry Golubkov'
 
 import os
 import re
-import math
 import random
 from deftcore.log import Logger
 from deftcore.settings import RUCIO_ACCOUNT_NAME, X509_PROXY_PATH
@@ -72,9 +71,7 @@ class RucioClient(object):
                 result.append('{0}:{1}'.format(scope, name))
         return result
 
-    def list_datasets_in_container(self, container):
-        dataset_names = list()
-
+    def iter_datasets_in_container(self, container):
         if container.endswith('/'):
             container = container[:-1]
 
@@ -85,15 +82,16 @@ class RucioClient(object):
                 for e in self.client.list_content(scope, container_name):
                     dsn = '{0}:{1}'.format(e['scope'], e['name'])
                     if e['type'] == 'DATASET':
-                        dataset_names.append(dsn)
+                        yield dsn
                     elif e['type'] == 'CONTAINER':
-                        names = self.list_datasets_in_container(dsn)
                         # FIXME: check not exist
-                        dataset_names.extend(names)
+                        yield from self.iter_datasets_in_container(dsn)
         except DataIdentifierNotFound:
             # FIXME
             pass
-        return dataset_names
+
+    def list_datasets_in_container(self, container):
+        return list(self.iter_datasets_in_container(container))
 
     def list_files_in_dataset(self, dsn):
         filename_list = list()
@@ -132,7 +130,7 @@ class RucioClient(object):
     def get_number_files(self, dsn):
         number_files = 0
         if self.is_dsn_container(dsn):
-            for name in self.list_datasets_in_container(dsn):
+            for name in self.iter_datasets_in_container(dsn):
                 number_files += self.get_number_files_from_metadata(name)
         else:
             number_files += self.get_number_files_from_metadata(dsn)
@@ -151,6 +149,34 @@ class RucioClient(object):
         except Exception as ex:
             raise Exception('DDM Error: rucio_client.get_metadata failed ({0}) ({1})'.format(str(ex), dataset))
 
+    def get_number_files_and_events_bulk(self, dsns):
+        """
+        :param dsns: list of dataset names
+        :return: dictionary {dataset name: (number of files, number of events)}, containers and
+        unknown names are skipped
+        """
+        dids = list()
+        dsn_by_did = dict()
+        for dsn in dsns:
+            scope, name = self.extract_scope(dsn)
+            dids.append({'scope': scope, 'name': name})
+            dsn_by_did[(scope, name)] = dsn
+        result = dict()
+        if not dids:
+            return result
+        # the default JSON plugin does not return did_type, length and events
+        for metadata in self.client.get_metadata_bulk(dids, plugin='DID_COLUMN'):
+            if metadata.get('did_type') != 'DATASET':
+                continue
+            dsn = dsn_by_did.get((metadata['scope'], metadata['name']))
+            if dsn:
+                result[dsn] = (int(metadata['length'] or 0), int(metadata['events'] or 0))
+        missing_dsns = [dsn for dsn in dsns if dsn not in result]
+        if missing_dsns:
+            logger.debug('get_number_files_and_events_bulk: no dataset metadata for {0}'.format(
+                ', '.join(missing_dsns)))
+        return result
+
     def erase(self, dsn, undo=False):
         scope, name = self.extract_scope(dsn)
         lifetime = 86400
@@ -267,7 +293,7 @@ class RucioClient(object):
         number_events = self.get_number_events(dsn)
         if not number_files:
             raise ValueError('Dataset {0} has no events or corresponding metadata (nEvents)'.format(dsn))
-        return math.ceil(float(number_events) / float(number_files))
+        return -(-number_events // number_files)
 
     def get_datasets_and_containers(self, input_data_name, datasets_contained_only=False):
         data_dict = {'containers': list(), 'datasets': list()}
@@ -10,17 +10,17 @@ import csv
 import io
 import ast
 import datetime
-import copy
 import math
 from copy import deepcopy
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
+from django.db.models import Q, Sum, Max
 from django.template import Context, Template
 from django.utils import timezone
 from distutils.version import LooseVersion
 from taskengine.models import StepExecution, TRequest, InputRequestList, TRequestStatus, ProductionTask, TTask, \
-    TTaskRequest, JEDIDataset, OpenEnded, ProductionDataset, HashTag, TConfig, StepAction, HashTagToRequest, GlobalShare, SliceError, TaskTemplate
+    TTaskRequest, JEDIDataset, OpenEnded, ProductionDataset, HashTag, TConfig, StepAction, HashTagToRequest, GlobalShare, SliceError, TaskTemplate, \
+    HashTagToTask
 from taskengine.protocol import Protocol, StepStatus, TaskParamName, TaskDefConstants, RequestStatus, TaskStatus
 from taskengine.taskreg import TaskRegistration
 from taskengine.metadata import AMIClient
@@ -34,6 +34,11 @@ import  xml.etree.ElementTree as ET
 
 logger = Logger.get()
 
+_INPUT_FILE_PARAM_RE = re.compile(r'^(--)?input.*File$', re.IGNORECASE)
+_PRIMARY_INPUT_PARAM_RE = re.compile(r'^(--)?input(?P<intype>.*)File', re.IGNORECASE)
+_MINBIAS_INPUT_TYPE_RE = re.compile(r'^(Low|High)PtMinbias.*$', re.IGNORECASE)
+_TID_DATASET_RE = re.compile(r'^.+_tid(?P<tid>\d+)_00$')
+
 
 class NotEnoughEvents(Exception):
     def __init__(self, previous_tasks):
@@ -235,6 +240,120 @@ def is_optimal_first_event(step: StepExecution) -> bool:
     return False
 
 
+# kinds of project_mode options copied to the task:
+# value - copied as it is, flag - False is passed as None, nonempty - copied only if it is not empty
+_OPTION_VALUE, _OPTION_FLAG, _OPTION_NONEMPTY = range(3)
+
+# ordered (project_mode option name, task parameter name, kind) triples;
+# order matters, later entries override earlier ones for the same task parameter
+_PROJECT_MODE_TASK_OPTIONS = (
+    ('ramCount', 'ram_count', _OPTION_VALUE),
+    ('baseRamCount', 'base_ram_count', _OPTION_VALUE),
+    ('baseWalltime', 'base_wall_time', _OPTION_VALUE),
+    ('maxCoreCount', 'max_core_count', _OPTION_VALUE),
+    ('nChunksToWait', 'number_of_chunks_to_wait', _OPTION_VALUE),
+    ('cpuTime', 'cpu_time', _OPTION_VALUE),
+    ('cpuTimeUnit', 'cpu_time_unit', _OPTION_VALUE),
+    ('workDiskCount', 'work_disk_count', _OPTION_VALUE),
+    ('workDiskUnit', 'work_disk_unit', _OPTION_VALUE),
+    ('ramUnit', 'ram_unit', _OPTION_VALUE),
+    ('nucleus', 'nucleus', _OPTION_VALUE),
+    ('workQueueName', 'work_queue_name', _OPTION_VALUE),
+    ('allowInputWAN', 'allow_input_wan', _OPTION_VALUE),
+    ('useJobCloning', 'use_job_cloning', _OPTION_VALUE),
+    ('altStageOut', 'alt_stage_out', _OPTION_VALUE),
+    ('cpuEfficiency', 'cpu_efficiency', _OPTION_VALUE),
+    ('maxEventsPerJob', 'max_events_per_job', _OPTION_VALUE),
+    ('intermediateTask', 'intermediate_task', _OPTION_VALUE),
+    ('esConsumers', 'number_of_es_consumers', _OPTION_VALUE),
+    ('esMaxAttempt', 'max_attempt_es', _OPTION_VALUE),
+    ('esMaxAttemptJob', 'max_attempt_es_job', _OPTION_VALUE),
+    ('nJumboJobs', 'number_of_jumbo_jobs', _OPTION_VALUE),
+    ('nEventsPerOutputFile', 'number_of_events_per_output_file', _OPTION_VALUE),
+    ('processingType', 'type', _OPTION_VALUE),
+    ('prodSourceLabel', 'prod_source', _OPTION_VALUE),
+    ('tgtMaxOutputForNG', 'tgt_max_output_for_ng', _OPTION_VALUE),
+    ('maxWalltime', 'max_walltime', _OPTION_VALUE),
+    ('scoutSuccessRate', 'scout_success_rate', _OPTION_VALUE),
+    ('useZipToPin', 'use_zip_to_pin', _OPTION_VALUE),
+    ('disableReassign', 'disable_reassign', _OPTION_FLAG),
+    ('skipScout', 'skip_scout_jobs', _OPTION_FLAG),
+    ('t1Weight', 't1_weight', _OPTION_FLAG),
+    ('lumiblock', 'respect_lb', _OPTION_FLAG),
+    ('noThrottle', 'no_throttle', _OPTION_FLAG),
+    ('respectSplitRule', 'respect_split_rule', _OPTION_FLAG),
+    ('skipShortInput', 'skip_short_input', _OPTION_FLAG),
+    ('skipShortOutput', 'skip_short_output', _OPTION_FLAG),
+    ('registerEsFiles', 'register_es_files', _OPTION_FLAG),
+    ('noWaitParent', 'no_wait_parent', _OPTION_FLAG),
+    ('usePrefetcher', 'use_prefetcher', _OPTION_FLAG),
+    ('disableAutoFinish', 'disable_auto_finish', _OPTION_FLAG),
+    ('inFilePosEvtNum', 'in_file_pos_evt_num', _OPTION_FLAG),
+    ('notDiscardEvents', 'not_discard_events', _OPTION_FLAG),
+    ('orderByLB', 'order_by_lb', _OPTION_FLAG),
+    ('noLoopingCheck', 'no_looping_check', _OPTION_FLAG),
+    ('taskBrokerOnMaster', 'task_broker_on_master', _OPTION_FLAG),
+    ('onSiteMerging', 'on_site_merging', _OPTION_FLAG),
+    ('releasePerLB', 'release_per_LB', _OPTION_FLAG),
+    ('toStaging', 'to_staging', _OPTION_FLAG),
+    ('inputPreStaging', 'input_pre_staging', _OPTION_FLAG),
+    ('allowEmptyInput', 'allow_empty_input', _OPTION_FLAG),
+    ('fullChain', 'full_chain', _OPTION_FLAG),
+    ('orderInputBy', 'order_input_by', _OPTION_FLAG),
+    ('containerName', 'container_name', _OPTION_FLAG),
+    ('tgtNumEventsPerJob', 'tgt_num_events_per_job', _OPTION_NONEMPTY),
+    ('nMaxFilesPerJob', 'number_of_max_files_per_job', _OPTION_NONEMPTY),
+    ('nSitesPerJob', 'number_of_sites_per_job', _OPTION_NONEMPTY),
+    ('nEventsPerWorker', 'number_of_events_per_worker', _OPTION_NONEMPTY),
+    ('transUsesPrefix', 'trans_uses_prefix', _OPTION_NONEMPTY),
+)
+
+
+def _apply_project_mode_options(project_mode, task_proto_dict):
+    for option_name, param_name, option_kind in _PROJECT_MODE_TASK_OPTIONS:
+        option_value = getattr(project_mode, option_name)
+        if option_kind == _OPTION_NONEMPTY:
+            if option_value:
+                task_proto_dict[param_name] = option_value
+        elif option_value is not None:
+            if option_kind == _OPTION_FLAG:
+                option_value = option_value or None
+            task_proto_dict[param_name] = option_value
+
+
+# io_intensity (kBPerS) of merge transformations
+_MERGE_IO_INTENSITY = {
+    'esdmerge_tf.py': 3000,
+    'histmerge_tf.py': 2000,
+    'evntmerge_tf.py': 4000,
+    'hitsmerge_tf.py': 3000,
+    'aodmerge_tf.py': 2000,
+    'ntupmerge_tf.py': 2000,
+    'daodmerge_tf.py': 2000,
+    'rdomerge_tf.py': 4000,
+}
+
+# releases which need the '_000' postfix of the input name in the event service merge job
+_ES_MERGE_POSTFIX_RELEASES = frozenset(['20.3.7.5', '20.7.8.7'])
+
+# sub-campaign -> compiled patterns of Rucio campaign metadata
+_SC_HASHTAG_PATTERNS = [(sub_campaign, [re.compile(pattern) for pattern in patterns])
+                        for sub_campaign, patterns in TaskDefConstants.DEFAULT_SC_HASHTAGS.items()]
+
+
+def _match_subcampaign(value):
+    for sub_campaign, patterns in _SC_HASHTAG_PATTERNS:
+        for pattern in patterns:
+            if pattern.match(value):
+                return sub_campaign
+    return None
+
+
+def _copy_evgen_input_params(input_params):
+    # values are scalars or flat lists of names, copy the lists so that splits do not share them
+    return {key: list(value) if isinstance(value, list) else value for key, value in input_params.items()}
+
+
 class TaskDefinition(object):
     def __init__(self, evgen_csv_encoding='utf-8'):
         self.evgen_csv_encoding = evgen_csv_encoding
@@ -635,11 +754,11 @@ class TaskDefinition(object):
                     input_params.update({'nEventsPerJob': events_per_job})
                     logger.info('Using nEventsPerJob from project_mode: nEventsPerJob={0}'.format(events_per_job))
             else:
-                result = self.rucio_client.get_datasets_and_containers(input_data_name, datasets_contained_only=True)
+                result = self._get_datasets_and_containers_cached(input_data_name, datasets_contained_only=True)
                 if use_containers and result['containers']:
                     input_data = result['containers']
                 elif use_containers:
-                    if not self.rucio_client.is_dsn_container(input_data_name):
+                    if not self._is_dsn_container_cached(input_data_name):
                         input_data = result['datasets']
                     else:
                         datasets = self.rucio_client.list_datasets_in_container(input_data_name)
@@ -758,9 +877,10 @@ class TaskDefinition(object):
         previous_task_list = ProductionTask.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']),
                                                   name=task_name)
         max_previous_offset = 0
-        for task in previous_task_list:
-            jedi_task = TTask.objects.get(id=task.id)
-            task_params = json.loads(jedi_task.jedi_task_param)
+        previous_task_ids = list(previous_task_list.values_list('id', flat=True))
+        self._prefetch_jedi_task_params(previous_task_ids)
+        for task_id in previous_task_ids:
+            task_params = self._get_jedi_task_params_cached(task_id)
             old_offset = 0
             old_offset_is_not_found = True
             is_optimal = False
@@ -775,7 +895,7 @@ class TaskDefinition(object):
             if ('nFiles' not in task_params) or ('nFilesPerJob' not in task_params) or old_offset_is_not_found:
                 raise Exception("Something wrong with optimal first event settings")
             if is_optimal:
-                max_previous_offset = max(max_previous_offset,old_offset + math.ceil(int(task_params['nFiles'])/int(task_params['nFilesPerJob'])))
+                max_previous_offset = max(max_previous_offset,old_offset + -(-int(task_params['nFiles']) // int(task_params['nFilesPerJob'])))
             else:
                 max_previous_offset = max(max_previous_offset,old_offset + int(task_params['nFiles']))
         return max_previous_offset
@@ -1046,14 +1166,12 @@ class TaskDefinition(object):
     @staticmethod
     def _get_primary_input(job_parameters):
         for job_param in job_parameters:
-            if 'param_type' not in list(job_param.keys()) or job_param['param_type'].lower() != 'input'.lower():
+            if 'param_type' not in job_param or job_param['param_type'].lower() != 'input':
                 continue
-            if re.match(r'^(--)?input.*File', job_param['value'], re.IGNORECASE):
-                result = re.match(r'^(--)?input(?P<intype>.*)File', job_param['value'], re.IGNORECASE)
-                if not result:
-                    continue
-                in_type = result.groupdict()['intype']
-                if in_type.lower() == 'logs'.lower() or re.match(r'^(Low|High)PtMinbias.*$', in_type, re.IGNORECASE):
+            result = _PRIMARY_INPUT_PARAM_RE.match(job_param['value'])
+            if result:
+                in_type = result.group('intype')
+                if in_type.lower() == 'logs' or _MINBIAS_INPUT_TYPE_RE.match(in_type):
                     continue
                 return job_param
         return None
@@ -1126,7 +1244,7 @@ class TaskDefinition(object):
             self._enum_next_tasks(int(next_task.id), data_type, list_task_id)
 
     def _extract_chain_input_from_datasets(self, dataset_name):
-        result = re.match(r'^.+_tid(?P<tid>\d+)_00$', dataset_name)
+        result = _TID_DATASET_RE.match(dataset_name)
         if result:
             parent_task = ProductionTask.objects.get(id=int(result.groupdict()['tid']))
             if parent_task.status in ['done']:
@@ -1386,6 +1504,7 @@ class TaskDefinition(object):
         if not previous_tasks:
             return
 
+        requested_output_types = frozenset(step.step_template.output_formats.split('.'))
         for previous_task_id in previous_tasks:
             task_list = ProductionTask.objects.filter(project=step.request.project,
                                                       ctag=step.step_template.ctag,
@@ -1394,10 +1513,7 @@ class TaskDefinition(object):
                 if prod_task.status in ['failed', 'broken', 'aborted', 'obsolete', 'toabort']:
                     continue
 
-                requested_output_types = step.step_template.output_formats.split('.')
-                previous_output_types = prod_task.output_formats
-                processed_output_types = [e for e in requested_output_types if e in previous_output_types.split('.')]
-                if not processed_output_types:
+                if requested_output_types.isdisjoint(prod_task.output_formats.split('.')):
                     continue
 
                 raise UnmergedInputProcessedException(prod_task.id)
@@ -1796,7 +1912,7 @@ class TaskDefinition(object):
             if prod_step.lower() == 'evgen'.lower():
                 if project_mode.optimalFirstEvent or task_config.get('optimalFirstEvent'):
                     max_offset = self._find_optimal_evnt_offset(task['taskName'])
-                    random_seed_param['offset'] = max(max_offset,math.ceil(number_of_input_files_used / task['nFilesPerJob']))
+                    random_seed_param['offset'] = max(max_offset,-(-number_of_input_files_used // task['nFilesPerJob']))
                 else:
                     events_per_file = int(task_config['nEventsPerInputFile'])
                     first_event_param = self._get_job_parameter('firstEvent', task['jobParameters'])
@@ -2117,6 +2233,105 @@ class TaskDefinition(object):
             self._tag_cache.update({tag_name: ctag})
         return ctag
 
+    def _get_sites_cached(self):
+        try:
+            available_sites = self._sites_cache
+        except AttributeError:
+            available_sites = self._sites_cache = frozenset(self.agis_client.get_sites())
+        return available_sites
+
+    def _get_ttcr_cached(self, project, prod_step, usergroup):
+        key = (project, prod_step.lower(), usergroup)
+        try:
+            ttcr = self._ttcr_cache.get(key)
+        except AttributeError:
+            self._ttcr_cache = dict()
+            ttcr = None
+        if ttcr is None:
+            ttcr = TConfig.get_ttcr(project, prod_step, usergroup)
+            self._ttcr_cache.update({key: ttcr})
+        return ttcr
+
+    def _get_project_mode_cached(self, step):
+        # task_config is a part of the key, so the cached object is not reused after the step config is changed
+        key = (step.id, step.task_config)
+        try:
+            project_mode = self._project_mode_cache.get(key)
+        except AttributeError:
+            self._project_mode_cache = dict()
+            project_mode = None
+        if project_mode is None:
+            project_mode = ProjectMode(step)
+            self._project_mode_cache.update({key: project_mode})
+        return project_mode
+
+    def _is_dsn_container_cached(self, dsn):
+        try:
+            is_container = self._dsn_container_cache.get(dsn)
+        except AttributeError:
+            self._dsn_container_cache = dict()
+            is_container = None
+        if is_container is None:
+            is_container = self.rucio_client.is_dsn_container(dsn)
+            self._dsn_container_cache.update({dsn: is_container})
+        return is_container
+
+    def _get_datasets_and_containers_cached(self, input_data_name, datasets_contained_only=False):
+        key = (input_data_name, datasets_contained_only)
+        try:
+            data_dict = self._datasets_and_containers_cache.get(key)
+        except AttributeError:
+            self._datasets_and_containers_cache = dict()
+            data_dict = None
+        if data_dict is None:
+            data_dict = self.rucio_client.get_datasets_and_containers(input_data_name,
+                                                                      datasets_contained_only=datasets_contained_only)
+            self._datasets_and_containers_cache.update({key: data_dict})
+        # callers may replace the lists in the result
+        return {key: list(value) for key, value in data_dict.items()}
+
+    def _get_number_files_cached(self, dsn):
+        try:
+            number_files = self._number_files_cache.get(dsn)
+        except AttributeError:
+            self._number_files_cache = dict()
+            number_files = None
+        if number_files is None:
+            number_files = self.rucio_client.get_number_files_from_metadata(dsn)
+            self._number_files_cache.update({dsn: number_files})
+        return number_files
+
+    def _prefetch_number_files(self, dsns):
+        try:
+            number_files_cache = self._number_files_cache
+        except AttributeError:
+            number_files_cache = self._number_files_cache = dict()
+        missing_dsns = [dsn for dsn in dsns if dsn not in number_files_cache]
+        for dsn, (number_files, _) in self.get_number_files_and_events_bulk(missing_dsns).items():
+            number_files_cache[dsn] = number_files
+
+    def _get_jedi_task_params_cached(self, task_id):
+        try:
+            task_params = self._jedi_task_params_cache.get(task_id)
+        except AttributeError:
+            self._jedi_task_params_cache = dict()
+            task_params = None
+        if task_params is None:
+            jedi_task = TTask.objects.only('id', 'jedi_task_param').get(id=task_id)
+            task_params = json.loads(jedi_task.jedi_task_param)
+            self._jedi_task_params_cache.update({task_id: task_params})
+        return task_params
+
+    def _prefetch_jedi_task_params(self, task_ids):
+        try:
+            jedi_task_params_cache = self._jedi_task_params_cache
+        except AttributeError:
+            jedi_task_params_cache = self._jedi_task_params_cache = dict()
+        missing_task_ids = [task_id for task_id in task_ids if task_id not in jedi_task_params_cache]
+        for task_id, jedi_task_param in \
+                TTask.objects.filter(id__in=missing_task_ids).values_list('id', 'jedi_task_param'):
+            jedi_task_params_cache[task_id] = json.loads(jedi_task_param)
+
     def _get_ami_transform_param_cached(self, trf_cache, trf_release, trf_transform, sub_step_list=False, force_dump_args=False,
                                         force_ami=False):
         sw_name = trf_cache + trf_release + trf_transform + str(sub_step_list) + str(force_dump_args) + str(force_ami)
@@ -2132,6 +2347,36 @@ class TaskDefinition(object):
             self._sw_cache.update({sw_name: (deepcopy(sw_transform), deepcopy(new_sub_step_list))})
         return sw_transform, new_sub_step_list
 
+    @staticmethod
+    def _replace_task_id(task, old_task_id, new_task_id):
+        """
+        Copy the task replacing the task id in all string values, the same way as replacing it in the serialized
+        task would do, but without the serialize/deserialize round trip
+        :param task: task dict (or any JSON-like value)
+        :param old_task_id: formatted task id to replace
+        :param new_task_id: formatted new task id
+        :return: copy of the task
+        """
+        if isinstance(task, str):
+            return task.replace(old_task_id, new_task_id)
+        if isinstance(task, dict):
+            return {TaskDefinition._replace_task_id(key, old_task_id, new_task_id):
+                    TaskDefinition._replace_task_id(value, old_task_id, new_task_id)
+                    for key, value in task.items()}
+        if isinstance(task, (list, tuple)):
+            return [TaskDefinition._replace_task_id(value, old_task_id, new_task_id) for value in task]
+        return task
+
+    @staticmethod
+    def _get_es_merge_spec(ami_tag, trf_release=None, auto_configuration=True):
+        auto_configuration_param = '--autoConfiguration=everything ' if auto_configuration else ''
+        name_postfix = '_000' if trf_release in _ES_MERGE_POSTFIX_RELEASES else ''
+        return {
+            'transPath': 'HITSMerge_tf.py',
+            'jobParameters': f'--AMITag {ami_tag} --DBRelease=current {auto_configuration_param}'
+                             f'--outputHitsFile=${{OUTPUT0}} --inputHitsFile=@inputFor_${{OUTPUT0}}{name_postfix}'
+        }
+
     @staticmethod
     def _check_task_events_consistency(task_config):
         n_events_input_file = int(task_config['nEventsPerInputFile'])
@@ -2150,7 +2395,7 @@ class TaskDefinition(object):
         logger.info("Processing step %d" % step_id)
 
         try:
-            first_step = StepExecution.objects.get(id=step_id)
+            first_step = StepExecution.objects.select_related('request', 'step_template').get(id=step_id)
             if first_step_number_of_events:
                 first_step.input_events = int(first_step_number_of_events)
         except ObjectDoesNotExist:
@@ -2168,7 +2413,8 @@ class TaskDefinition(object):
 
         while step is not None:
             try:
-                step = StepExecution.objects.get(~Q(id=step.id), step_parent_id=step.id, slice=first_step.slice)
+                step = StepExecution.objects.select_related('request', 'step_template').get(
+                    ~Q(id=step.id), step_parent_id=step.id, slice=first_step.slice)
                 if step.status.lower() == self.protocol.STEP_STATUS[StepStatus.APPROVED].lower():
                     chain.append(step)
             except ObjectDoesNotExist:
@@ -2480,9 +2726,9 @@ class TaskDefinition(object):
                         task_config.keys()):
                     real_input_events = 0
                     for key in list(input_params.keys()):
-                        if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                        if _INPUT_FILE_PARAM_RE.match(key):
                             for input_name in input_params[key]:
-                                result = re.match(r'^.+_tid(?P<tid>\d+)_00$', input_name)
+                                result = _TID_DATASET_RE.match(input_name)
                                 if result:
                                     if parent_task_id == int(result.groupdict()['tid']):
                                         continue
@@ -2644,7 +2890,7 @@ class TaskDefinition(object):
             elif trf_name.lower() == 'POOLtoEI_tf.py'.lower():
                 use_no_output = True
                 for key in list(input_params.keys()):
-                    if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                    if _INPUT_FILE_PARAM_RE.match(key):
                         input_params['inputPOOLFile'] = input_params[key]
                         del input_params[key]
             elif trf_name.lower() == 'HITSMerge_tf.py'.lower():
@@ -2662,7 +2908,7 @@ class TaskDefinition(object):
                         if re.match(r'^.+_tid(?P<tid>\d+)_00$', name, re.IGNORECASE):
                             input_params[key].remove(name)
                 for key in list(input_params.keys()):
-                    if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                    if _INPUT_FILE_PARAM_RE.match(key):
                         input_params['inputBSCONFIGFile'] = input_params[key]
                         del input_params[key]
             elif trf_name.lower() == 'ReSim_tf.py'.lower():
@@ -2675,7 +2921,7 @@ class TaskDefinition(object):
                 input_data_name = self.get_step_input_data_name(step)
             else:
                 for key in list(input_params.keys()):
-                    if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                    if _INPUT_FILE_PARAM_RE.match(key):
                         if len(input_params[key]):
                             input_data_name = input_params[key][0]
                             break
@@ -2778,7 +3024,7 @@ class TaskDefinition(object):
             if prod_step.lower() == 'evgen'.lower():
                 evgen_number_input_files = 0
                 for key in list(input_params.keys()):
-                    if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                    if _INPUT_FILE_PARAM_RE.match(key):
                         for input_name in input_params[key]:
                             evgen_number_input_files += self.rucio_client.get_number_files(input_name)
                             try:
@@ -3396,7 +3642,7 @@ class TaskDefinition(object):
                         job_parameters.append(second_input_param)
 
                     is_pile_task = True
-                elif re.match(r'^(--)?input.*File$', name, re.IGNORECASE):
+                elif _INPUT_FILE_PARAM_RE.match(name):
                     param_name = re.sub("(?<=input)evgen(?=file)", "EVNT".lower(), name.lower())
                     # BS (byte stream) - for all *RAW* (DRAW, RAW, DRAW_ZEE, etc.) [2]
                     if re.match(r'^(--)?inputBSFile$', name, re.IGNORECASE) and 'RAW'.lower() in ','.join(
@@ -3619,9 +3865,7 @@ class TaskDefinition(object):
                     )
                 else:
                     param_value = self._get_parameter_value(name, ctag, sub_steps=trf_sub_steps)
-                    if not param_value or str(param_value).lower() == 'none':
-                        continue
-                    if str(param_value).lower() == 'none,none':
+                    if not param_value or str(param_value).lower() in ('none', 'none,none'):
                         continue
                     param_dict = {'name': name, 'value': param_value}
                     param_dict.update(trf_options)
@@ -3635,7 +3879,7 @@ class TaskDefinition(object):
                     if re.match('^(--)?validationFlags', name, re.IGNORECASE):
                         param_dict.update({'separator': ' '})
                     elif re.match('^(--)?skipFileValidation', name, re.IGNORECASE):
-                        if param_value.lower() == 'True'.lower():
+                        if param_value.lower() == 'true':
                             param_dict.update({'separator': ''})
                             param_dict.update({'value': ''})
                         else:
@@ -3688,7 +3932,7 @@ class TaskDefinition(object):
                     if not result:
                         continue
                     in_type = result.groupdict()['intype']
-                    if in_type.lower() == 'logs'.lower() or \
+                    if in_type.lower() == 'logs' or \
                             re.match(r'^.*(PtMinbias|Cavern|ZeroBiasBS|HITAR|Filter|RDO_BKG).*$', in_type,
                                      re.IGNORECASE):
                         continue
@@ -3698,7 +3942,7 @@ class TaskDefinition(object):
                     job_parameters.insert(0, job_param)
                 if 'param_type' not in list(job_param.keys()):
                     continue
-                if job_param['param_type'].lower() == 'output'.lower():
+                if job_param['param_type'].lower() == 'output':
                     no_output = False
                     if 'dataset' in list(job_param.keys()):
                         output_dataset_dict = self.parse_data_name(job_param['dataset'])
@@ -3717,6 +3961,11 @@ class TaskDefinition(object):
                     .format(message, ctag_name, trf_name, trf_cache, trf_release, ','.join(param_names))
                 raise Exception(message)
 
+            request_type = step.request.request_type.lower()
+            phys_group = step.request.phys_group.lower()
+            prod_step_name = prod_step.lower()
+            trf_name_lower = trf_name.lower()
+
             log_param_dict = {'dataset': output_params['outputlogFile'][0], 'task_id': task_proto_id}
             log_param_dict.update(trf_options)
             log_param = self.protocol.render_param(TaskParamName.LOG, log_param_dict)
@@ -3724,8 +3973,8 @@ class TaskDefinition(object):
                 log_param['transient'] = not is_not_transient_output
             if leave_log:
                 self.protocol.set_leave_log_param(log_param)
-            if 'token' in list(task_config.keys()):
-                if (step.request.request_type.lower() in ['GROUP'.lower()]) or project_mode.useDestForLogs:
+            if 'token' in task_config:
+                if request_type == 'group' or project_mode.useDestForLogs:
                     log_param['token'] = task_config['token']
             if 'Data' in input_types_defined:
                 for job_param in job_parameters:
@@ -3734,22 +3983,22 @@ class TaskDefinition(object):
                             job_parameters.remove(job_param)
                             break
 
-            if trf_name.lower() == 'DigiMReco_trf.py'.lower():
-                if 'outputESDFile' not in list(output_params.keys()):
+            if trf_name_lower == 'digimreco_trf.py':
+                if 'outputESDFile' not in output_params:
                     param_dict = {'name': 'outputESDFile', 'value': 'ESD.TMP._0000000_tmp.pool.root'}
                     param_dict.update(trf_options)
                     job_parameters.append(
                         self.protocol.render_param(TaskParamName.CONSTANT, param_dict)
                     )
-            elif trf_name.lower() == 'Trig_reco_tf.py'.lower() or trf_name.lower() == 'TrigMT_reco_tf.py'.lower():
+            elif trf_name_lower == 'trig_reco_tf.py' or trf_name_lower == 'trigmt_reco_tf.py':
                 for job_param in job_parameters[:]:
                     if re.match('^(--)?jobNumber$', job_param['value'], re.IGNORECASE):
                         job_parameters.remove(job_param)
                         break
-            elif trf_name.lower() == 'csc_MergeHIST_trf.py'.lower():
+            elif trf_name_lower == 'csc_mergehist_trf.py':
                 for job_param in job_parameters[:]:
                     job_param['value'] = job_param['value'].split('=')[-1]
-            elif trf_name.lower() == 'POOLtoEI_tf.py'.lower():
+            elif trf_name_lower == 'pooltoei_tf.py':
                 if use_no_output:
                     param_dict = {'name': '--outputEIFile', 'value': 'temp.ei.spb'}
                     if ei_output_filename:
@@ -3760,7 +4009,7 @@ class TaskDefinition(object):
                     )
 
             if env_params_dict:
-                for key in list(env_params_dict.keys()):
+                for key in env_params_dict:
                     param_dict = {'name': '--env {0}'.format(key), 'value': env_params_dict[key]}
                     options = {'separator': '='}
                     param_dict.update(options)
@@ -3768,19 +4017,19 @@ class TaskDefinition(object):
                         self.protocol.render_param(TaskParamName.CONSTANT, param_dict)
                     )
 
-            if project_mode.reprocessing or (step.request.phys_group.lower() == 'REPR'.lower()):
+            if project_mode.reprocessing or (phys_group == 'repr'):
                 task_type = 'reprocessing'
             else:
                 task_type = prod_step
                 if is_pile_task:
                     task_type = 'pile'
-            if prod_step.lower() == 'archive'.lower():
+            if prod_step_name == 'archive':
                 task_type = prod_step
 
             campaign = ':'.join([_f for _f in (step.request.campaign, step.request.subcampaign, bunchspacing,) if _f])
 
             task_request_type = None
-            if step.request.request_type.lower() == 'TIER0'.lower():
+            if request_type == 'tier0':
                 task_request_type = 'T0spillover'
 
             task_trans_home_separator = '-'
@@ -3826,14 +4075,14 @@ class TaskDefinition(object):
             core_count = 1
             if project_mode.coreCount is not None:
                 core_count = project_mode.coreCount
-                task_proto_dict.update({'number_of_cpu_cores': core_count})
+                task_proto_dict['number_of_cpu_cores'] = core_count
 
             # https://twiki.cern.ch/twiki/bin/view/AtlasComputing/ProdSys#Default_cpuTime_cpu_TimeUnit_tab
             # https://twiki.cern.ch/twiki/bin/view/AtlasComputing/ProdSys#Default_base_RamCount_ramCount_r
-            if step.request.request_type.lower() == 'MC'.lower():
-                if prod_step.lower() == 'simul'.lower():
-                    task_proto_dict.update({'cpu_time': 3000})
-                    task_proto_dict.update({'cpu_time_unit': 'HS06sPerEvent'})
+            if request_type == 'mc':
+                if prod_step_name == 'simul':
+                    task_proto_dict['cpu_time'] = 3000
+                    task_proto_dict['cpu_time_unit'] = 'HS06sPerEvent'
                     if core_count > 1:
                         if [x for x in job_parameters if 'multithreaded' in x.get('value','')]:
                             memory = 150
@@ -3841,55 +4090,45 @@ class TaskDefinition(object):
                         else:
                             memory = 500
                             base_memory = 1000
-                elif prod_step.lower() == 'recon'.lower() or is_pile_task:
+                elif prod_step_name == 'recon' or is_pile_task:
                     if core_count > 1:
                         memory = 1750
                         base_memory = 2000
-            elif step.request.request_type.lower() == 'HLT'.lower():
-                if prod_step.lower() == 'recon'.lower():
-                    task_proto_dict.update({'cpu_time': 300})
-                    task_proto_dict.update({'cpu_time_unit': 'HS06sPerEvent'})
+            elif request_type == 'hlt':
+                if prod_step_name == 'recon':
+                    task_proto_dict['cpu_time'] = 300
+                    task_proto_dict['cpu_time_unit'] = 'HS06sPerEvent'
                     memory = 4000
-                elif prod_step.lower() == 'merge'.lower():
-                    if 'HIST'.lower() in '.'.join([e.lower() for e in output_types_defined]):
-                        task_proto_dict.update({'cpu_time': 0})
+                elif prod_step_name == 'merge':
+                    if 'hist' in '.'.join([e.lower() for e in output_types_defined]):
+                        task_proto_dict['cpu_time'] = 0
                     else:
-                        task_proto_dict.update({'cpu_time': 1})
-                    task_proto_dict.update({'cpu_time_unit': 'HS06sPerEvent'})
-            elif step.request.request_type.lower() == 'GROUP'.lower():
-                task_proto_dict.update({'cpu_time': 0})
-                task_proto_dict.update({'cpu_time_unit': 'HS06sPerEvent'})
-                task_proto_dict.update({'base_wall_time': 60})
-                task_proto_dict.update({'cpu_time': 200})
+                        task_proto_dict['cpu_time'] = 1
+                    task_proto_dict['cpu_time_unit'] = 'HS06sPerEvent'
+            elif request_type == 'group':
+                task_proto_dict['cpu_time'] = 0
+                task_proto_dict['cpu_time_unit'] = 'HS06sPerEvent'
+                task_proto_dict['base_wall_time'] = 60
+                task_proto_dict['cpu_time'] = 200
                 if project.lower().startswith('data'):
-                    task_proto_dict.update({'goal': str(100.0)})
-                    task_proto_dict.update({'use_exhausted': True})
+                    task_proto_dict['goal'] = str(100.0)
+                    task_proto_dict['use_exhausted'] = True
                 if core_count > 1:
                     memory = 1750
                     base_memory = 2000
 
             if trf_name in ['AODMerge_tf.py', 'DAODMerge_tf.py', 'Archive_tf.py', 'ESDMerge_tf.py', 'RDOMerge_tf.py',
                             'ReSim_tf.py']:
-                task_proto_dict.update({'out_disk_count': 1000})
-                task_proto_dict.update({'out_disk_unit': 'kB'})
-
-            task_proto_dict.update({'ram_count': int(memory)})
-            task_proto_dict.update({'base_ram_count': int(base_memory)})
-            task_proto_dict.update({'ram_unit': 'MBPerCore'})
-
-            if step.request.request_type.lower() == 'GROUP'.lower():
-                task_proto_dict.update({'respect_split_rule': True})
-
-            if project_mode.ramCount is not None:
-                task_proto_dict.update({'ram_count': project_mode.ramCount})
-            if project_mode.baseRamCount is not None:
-                task_proto_dict.update({'base_ram_count': project_mode.baseRamCount})
-            if project_mode.baseWalltime is not None:
-                task_proto_dict.update({'base_wall_time': project_mode.baseWalltime})
-            if project_mode.maxCoreCount is not None:
-                task_proto_dict.update({'max_core_count': project_mode.maxCoreCount})
-            if project_mode.nChunksToWait is not None:
-                task_proto_dict.update({'number_of_chunks_to_wait': project_mode.nChunksToWait})
+                task_proto_dict['out_disk_count'] = 1000
+                task_proto_dict['out_disk_unit'] = 'kB'
+
+            task_proto_dict['ram_count'] = int(memory)
+            task_proto_dict['base_ram_count'] = int(base_memory)
+            task_proto_dict['ram_unit'] = 'MBPerCore'
+
+            if request_type == 'group':
+                task_proto_dict['respect_split_rule'] = True
+
             if project_mode.site is not None:
                 site_value = project_mode.site
                 specified_sites = list()
@@ -3897,11 +4136,11 @@ class TaskDefinition(object):
                     specified_sites.extend(site_value.split(','))
                 else:
                     specified_sites.append(site_value)
-                available_sites = self.agis_client.get_sites()
+                available_sites = self._get_sites_cached()
                 for site_name in specified_sites:
                     if site_name not in available_sites:
                         raise UnknownSiteException(site_name)
-                task_proto_dict.update({'site': site_value})
+                task_proto_dict['site'] = site_value
             if project_mode.excludedSites is not None:
                 site_value = project_mode.excludedSites
                 specified_sites = list()
@@ -3909,32 +4148,20 @@ class TaskDefinition(object):
                     specified_sites.extend(site_value.split(','))
                 else:
                     specified_sites.append(site_value)
-                available_sites = self.agis_client.get_sites()
+                available_sites = self._get_sites_cached()
                 for site_name in specified_sites:
                     if site_name not in available_sites:
                         raise UnknownSiteException(site_name)
-                task_proto_dict.update({'excludedSites': site_value})
+                task_proto_dict['excludedSites'] = site_value
 
-            if project_mode.disableReassign is not None:
-                task_proto_dict.update({'disable_reassign': project_mode.disableReassign or None})
-
-            if project_mode.skipScout is not None:
-                task_proto_dict.update({'skip_scout_jobs': project_mode.skipScout or None})
-
-            if project_mode.t1Weight is not None:
-                task_proto_dict.update({'t1_weight': project_mode.t1Weight or None})
-
-            if project_mode.lumiblock is not None:
-                task_proto_dict.update({'respect_lb': project_mode.lumiblock or None})
-
-            if project.lower() == 'mc14_ruciotest'.lower():
-                task_proto_dict.update({'ddm_back_end': 'rucio'})
-                task_proto_dict.update({'prod_source': 'rucio_test'})
+            if project.lower() == 'mc14_ruciotest':
+                task_proto_dict['ddm_back_end'] = 'rucio'
+                task_proto_dict['prod_source'] = 'rucio_test'
 
             if no_input and number_of_events > 0:
-                task_proto_dict.update({'number_of_events': number_of_events})
+                task_proto_dict['number_of_events'] = number_of_events
             elif not no_input and number_of_events > 0:
-                if prod_step.lower() != 'evgen'.lower() and 'nEventsPerInputFile' in list(task_config.keys()):
+                if prod_step_name != 'evgen' and 'nEventsPerInputFile' in task_config:
                     number_input_files_requested = \
                         math.ceil(number_of_events / int(task_config['nEventsPerInputFile']))
                     if number_input_files_requested == 0:
@@ -3942,195 +4169,142 @@ class TaskDefinition(object):
                             "Number of requested input files is null (Input events=%d, nEventsPerInputFile=%d)" %
                             (int(number_of_events), int(task_config['nEventsPerInputFile']))
                         )
-                    task_proto_dict.update({'number_of_files': int(number_input_files_requested)})
-                elif prod_step.lower() != 'evgen'.lower() and 'nEventsPerInputFile' not in list(task_config.keys()):
-                    task_proto_dict.update({'number_of_events': number_of_events})
+                    task_proto_dict['number_of_files'] = int(number_input_files_requested)
+                elif prod_step_name != 'evgen' and 'nEventsPerInputFile' not in task_config:
+                    task_proto_dict['number_of_events'] = number_of_events
 
             if no_input:
-                task_proto_dict.update({'no_primary_input': no_input})
-                if 'number_of_events' not in list(task_proto_dict.keys()):
+                task_proto_dict['no_primary_input'] = no_input
+                if 'number_of_events' not in task_proto_dict:
                     raise Exception("Number of events to be processed is mandatory when task has no input")
 
-            if no_input and prod_step.lower() not in ['evgen', 'simul']:
+            if no_input and prod_step_name not in ['evgen', 'simul']:
                 raise Exception('This type of task ({0}) cannot be submitted without input'.format(prod_step))
 
-            if 'nFiles' in list(task_config.keys()):
+            if 'nFiles' in task_config:
                 number_of_files = int(task_config['nFiles'])
-                task_proto_dict.update({'number_of_files': number_of_files})
+                task_proto_dict['number_of_files'] = number_of_files
 
-            if 'nEvents' in list(task_config.keys()):
-                task_proto_dict.update({'number_of_events': int(task_config['nEvents'])})
+            if 'nEvents' in task_config:
+                task_proto_dict['number_of_events'] = int(task_config['nEvents'])
 
-            if 'nEventsPerInputFile' in list(task_config.keys()) and not no_input:
+            if 'nEventsPerInputFile' in task_config and not no_input:
                 number_of_events_per_input_file = int(task_config['nEventsPerInputFile'])
-                task_proto_dict.update({'number_of_events_per_input_file': number_of_events_per_input_file})
+                task_proto_dict['number_of_events_per_input_file'] = number_of_events_per_input_file
 
-            if 'nEventsPerJob' in list(task_config.keys()):
+            if 'nEventsPerJob' in task_config:
                 number_of_events_per_job = int(task_config['nEventsPerJob'])
-                task_proto_dict.update({'number_of_events_per_job': number_of_events_per_job})
+                task_proto_dict['number_of_events_per_job'] = number_of_events_per_job
 
-            if 'nFilesPerJob' in list(task_config.keys()):
+            if 'nFilesPerJob' in task_config:
                 number_of_files_per_job = int(task_config['nFilesPerJob'])
                 if number_of_files_per_job == 0:
-                    task_proto_dict.update({'number_of_files_per_job': None})
+                    task_proto_dict['number_of_files_per_job'] = None
                 else:
-                    task_proto_dict.update({'number_of_files_per_job': number_of_files_per_job})
+                    task_proto_dict['number_of_files_per_job'] = number_of_files_per_job
                 if number_of_files_per_job > TaskDefConstants.DEFAULT_MAX_FILES_PER_JOB:
-                    task_proto_dict.update({'number_of_max_files_per_job': number_of_files_per_job})
+                    task_proto_dict['number_of_max_files_per_job'] = number_of_files_per_job
 
-            if 'nEventsPerRange' in list(task_config.keys()):
+            if 'nEventsPerRange' in task_config:
                 number_of_events_per_range = int(task_config['nEventsPerRange'])
-                task_proto_dict.update({'number_of_events_per_range': number_of_events_per_range})
+                task_proto_dict['number_of_events_per_range'] = number_of_events_per_range
 
-            if ('nEventsPerInputFile' in list(task_config.keys()) and 'nEventsPerJob' in list(task_config.keys())) and not('nFilesPerJob' in list(task_config.keys())):
+            if ('nEventsPerInputFile' in task_config and 'nEventsPerJob' in task_config) and 'nFilesPerJob' not in task_config:
                 number_of_max_files_per_job = int(task_config['nEventsPerJob']) / int(task_config['nEventsPerInputFile'])
                 if number_of_max_files_per_job > TaskDefConstants.DEFAULT_MAX_FILES_PER_JOB:
-                    task_proto_dict.update({'number_of_max_files_per_job': math.ceil(number_of_max_files_per_job)})
+                    task_proto_dict['number_of_max_files_per_job'] = math.ceil(number_of_max_files_per_job)
 
-            if 'nGBPerJob' in list(task_config.keys()):
+            if 'nGBPerJob' in task_config:
                 number_of_gb_per_job = int(task_config['nGBPerJob'])
-                task_proto_dict.update({'number_of_gb_per_job': number_of_gb_per_job})
+                task_proto_dict['number_of_gb_per_job'] = number_of_gb_per_job
 
-            if 'maxAttempt' in list(task_config.keys()):
+            if 'maxAttempt' in task_config:
                 max_attempt = int(task_config['maxAttempt'])
-                task_proto_dict.update({'max_attempt': max_attempt})
+                task_proto_dict['max_attempt'] = max_attempt
 
-            if 'outputPostProcessing' in list(task_config.keys()):
-                task_proto_dict.update({'output_post_processing': task_config['outputPostProcessing']})
+            if 'outputPostProcessing' in task_config:
+                task_proto_dict['output_post_processing'] = task_config['outputPostProcessing']
 
-            if 'multiStepExec' in list(task_config.keys()):
-                task_proto_dict.update({'multi_step_exec': task_config['multiStepExec']})
+            if 'multiStepExec' in task_config:
+                task_proto_dict['multi_step_exec'] = task_config['multiStepExec']
 
-            if 'container_name' in list(task_config.keys()):
-                task_proto_dict.update({'container_name': task_config['container_name']})
+            if 'container_name' in task_config:
+                task_proto_dict['container_name'] = task_config['container_name']
 
-            if 'onlyTagsForFC' in list(task_config.keys()):
+            if 'onlyTagsForFC' in task_config:
                 if task_config['onlyTagsForFC']:
-                    task_proto_dict.update({'only_tags_for_fc': task_config['onlyTagsForFC']})
+                    task_proto_dict['only_tags_for_fc'] = task_config['onlyTagsForFC']
 
-            if 'full_chain' in list(task_config.keys()):
+            if 'full_chain' in task_config:
                 if task_config['full_chain']:
-                    task_proto_dict.update({'full_chain': task_config['full_chain']})
+                    task_proto_dict['full_chain'] = task_config['full_chain']
 
-            if 'maxFailure' in list(task_config.keys()):
+            if 'maxFailure' in task_config:
                 max_failure = int(task_config['maxFailure'])
-                task_proto_dict.update({'max_failure': max_failure})
+                task_proto_dict['max_failure'] = max_failure
 
-            if 'nEventsPerMergeJob' in list(task_config.keys()):
+            if 'nEventsPerMergeJob' in task_config:
                 number_of_events_per_merge_job = int(task_config['nEventsPerMergeJob'])
-                task_proto_dict.update({'number_of_events_per_merge_job': number_of_events_per_merge_job})
+                task_proto_dict['number_of_events_per_merge_job'] = number_of_events_per_merge_job
 
-            if step.request.phys_group.lower() in [e.lower() for e in ['THLT', 'REPR']]:
-                task_proto_dict.update({'no_throttle': True})
+            if phys_group in ['thlt', 'repr']:
+                task_proto_dict['no_throttle'] = True
 
-            if step.request.phys_group.lower() in [e.lower() for e in ['REPR']]:
-                task_proto_dict.update({'use_exhausted': True})
+            if phys_group == 'repr':
+                task_proto_dict['use_exhausted'] = True
 
-            if step.request.request_type.lower() == 'EVENTINDEX'.lower():
-                task_proto_dict.update(({'ip_connectivity': "'full'"}))
+            if request_type == 'eventindex':
+                task_proto_dict['ip_connectivity'] = "'full'"
 
             if mc_pileup_overlay['is_overlay']:
-                task_proto_dict.update({'task_broker_on_master': True})
+                task_proto_dict['task_broker_on_master'] = True
 
             if project_mode.ipConnectivity is not None:
-                task_proto_dict.update({'ip_connectivity': "'%s'" % project_mode.ipConnectivity})
-
-            if project_mode.tgtNumEventsPerJob:
-                task_proto_dict.update({'tgt_num_events_per_job': project_mode.tgtNumEventsPerJob})
-
-            if project_mode.cpuTime is not None:
-                task_proto_dict.update({'cpu_time': project_mode.cpuTime})
-
-            if project_mode.cpuTimeUnit is not None:
-                task_proto_dict.update({'cpu_time_unit': project_mode.cpuTimeUnit})
+                task_proto_dict['ip_connectivity'] = "'%s'" % project_mode.ipConnectivity
 
             if project_mode.iointensity is not None:
-                task_proto_dict.update({'io_intensity': project_mode.iointensity})
-                task_proto_dict.update({'io_intensity_unit': 'kBPerS'})
+                task_proto_dict['io_intensity'] = project_mode.iointensity
+                task_proto_dict['io_intensity_unit'] = 'kBPerS'
 
             if project_mode.gshare is not None:
                 all_gshares = GlobalShare.objects.all().values_list('name',flat=True)
                 for gshare in all_gshares:
                     if gshare.replace(" ","") == project_mode.gshare:
-                        task_proto_dict.update({'global_share': gshare})
+                        task_proto_dict['global_share'] = gshare
                         break
 
-            if project_mode.workDiskCount is not None:
-                task_proto_dict.update({'work_disk_count': project_mode.workDiskCount})
-
-            if project_mode.workDiskUnit is not None:
-                task_proto_dict.update({'work_disk_unit': project_mode.workDiskUnit})
-
             if project_mode.goal is not None:
-                task_proto_dict.update({'goal': project_mode.goal})
+                task_proto_dict['goal'] = project_mode.goal
                 if str(project_mode.goal) == '100':
-                    task_proto_dict.update({'use_exhausted': True})
+                    task_proto_dict['use_exhausted'] = True
 
             if project_mode.skipFilesUsedBy:
-                task_proto_dict.update({'skip_files_used_by': project_mode.skipFilesUsedBy})
+                task_proto_dict['skip_files_used_by'] = project_mode.skipFilesUsedBy
                 skip_check_input = True
 
-            if project_mode.noThrottle is not None:
-                task_proto_dict.update({'no_throttle': project_mode.noThrottle or None})
-
-            if project_mode.ramUnit is not None:
-                task_proto_dict.update({'ram_unit': project_mode.ramUnit})
-
-            if project_mode.baseRamCount is not None:
-                task_proto_dict.update({'base_ram_count': project_mode.baseRamCount})
-
-            if project_mode.nucleus is not None:
-                task_proto_dict.update({'nucleus': project_mode.nucleus})
-
-            if project_mode.workQueueName is not None:
-                task_proto_dict.update({'work_queue_name': project_mode.workQueueName})
-
-            if project_mode.allowInputWAN is not None:
-                task_proto_dict.update({'allow_input_wan': project_mode.allowInputWAN})
-
             if project_mode.allowInputLAN is not None:
-                task_proto_dict.update({'allow_input_lan': "'{0}'".format(project_mode.allowInputLAN)})
-
-            if project_mode.nMaxFilesPerJob:
-                task_proto_dict.update({'number_of_max_files_per_job': project_mode.nMaxFilesPerJob})
+                task_proto_dict['allow_input_lan'] = "'{0}'".format(project_mode.allowInputLAN)
 
             ttcr_timestamp = None
 
-            try:
-                if not self.template_type:
-                    ttcr = TConfig.get_ttcr(project, prod_step, usergroup)
-                    if ttcr > 0:
-                        ttcr_timestamp = timezone.now() + datetime.timedelta(seconds=ttcr)
-                        task_proto_dict.update({'ttcr_timestamp': str(ttcr_timestamp)})
-            except Exception as ex:
-                logger.exception('Getting TTC failed: {0}'.format(str(ex)))
-
-            if project_mode.useJobCloning is not None:
-                task_proto_dict.update({'use_job_cloning': project_mode.useJobCloning})
-
-            if project_mode.nSitesPerJob:
-                task_proto_dict.update({'number_of_sites_per_job': project_mode.nSitesPerJob})
-
-            if project_mode.altStageOut is not None:
-                task_proto_dict.update({'alt_stage_out': project_mode.altStageOut})
-
-            if project_mode.cpuEfficiency is not None:
-                task_proto_dict.update({'cpu_efficiency': project_mode.cpuEfficiency})
+            if not self.template_type:
+                try:
+                    ttcr = self._get_ttcr_cached(project, prod_step, usergroup)
+                except Exception as ex:
+                    ttcr = 0
+                    logger.exception('Getting TTC failed: {0}'.format(str(ex)))
+                if ttcr > 0:
+                    ttcr_timestamp = timezone.now() + datetime.timedelta(seconds=ttcr)
+                    task_proto_dict['ttcr_timestamp'] = str(ttcr_timestamp)
 
             if project_mode.minGranularity is not None:
-                task_proto_dict.update({'min_granularity': project_mode.minGranularity})
+                task_proto_dict['min_granularity'] = project_mode.minGranularity
                 if project_mode.maxEventsPerJob is None:
-                    task_proto_dict.update({'max_events_per_job': TaskDefConstants.DEFAULT_MAX_EVENTS_PER_GRANULE_JOB})
-
-            if project_mode.maxEventsPerJob is not None:
-                task_proto_dict.update({'max_events_per_job': project_mode.maxEventsPerJob})
+                    task_proto_dict['max_events_per_job'] = TaskDefConstants.DEFAULT_MAX_EVENTS_PER_GRANULE_JOB
 
-            if project_mode.respectSplitRule is not None:
-                task_proto_dict.update({'respect_split_rule': project_mode.respectSplitRule or None})
-
-            if step.request.request_type.lower() == 'MC'.lower():
-                if prod_step.lower() == 'simul'.lower() and len(trf_release.split('.')) > 2 and \
-                        ('.'.join(trf_release.split('.')[0:3]) in ['21.0.15','21.0.31']) and trf_name in ['Sim_tf.py']:
+            if request_type == 'mc':
+                if prod_step_name == 'simul' and trf_release_base in ['21.0.15', '21.0.31'] and \
+                        trf_name in ['Sim_tf.py']:
                     if project_mode.esConvertible is None:
                         project_mode.esConvertible = True
 
@@ -4139,223 +4313,89 @@ class TaskDefinition(object):
 
             if project_mode.esFraction is not None:
                 if project_mode.esFraction > 0:
-                    task_proto_dict.update({'es_fraction': project_mode.esFraction})
-                    task_proto_dict.update({'es_convertible': True})
+                    task_proto_dict['es_fraction'] = project_mode.esFraction
+                    task_proto_dict['es_convertible'] = True
                     project_mode.esMerging = True
 
             if project_mode.esConvertible is not None:
                 if project_mode.esConvertible:
-                    task_proto_dict.update({'es_convertible': True})
+                    task_proto_dict['es_convertible'] = True
                     project_mode.esMerging = True
                     task_proto_dict['not_discard_events'] = True
                 else:
-                    task_proto_dict.update({'es_convertible': None})
+                    task_proto_dict['es_convertible'] = None
 
             if project_mode.onSiteMerging is not None:
-                es_merging_tag_name = ctag_name
-                es_merging_trf_name = 'HITSMerge_tf.py'
-                task_proto_dict['es_merge_spec'] = {}
-                task_proto_dict['es_merge_spec']['transPath'] = es_merging_trf_name
-                task_proto_dict['es_merge_spec']['jobParameters'] = \
-                    '--AMITag {0} --DBRelease=current '.format(
-                        es_merging_tag_name) + \
-                    '--outputHitsFile=${OUTPUT0} --inputHitsFile=@inputFor_${OUTPUT0}'
-
-            if project_mode.intermediateTask is not None:
-                task_proto_dict.update({'intermediate_task': project_mode.intermediateTask})
+                task_proto_dict['es_merge_spec'] = self._get_es_merge_spec(ctag_name, auto_configuration=False)
 
             if project_mode.esMerging is not None:
                 if project_mode.esMerging and not project_mode.onSiteMerging:
-                    es_merging_tag_name = ctag_name
-                    es_merging_trf_name = 'HITSMerge_tf.py'
-                    task_proto_dict['es_merge_spec'] = {}
-                    task_proto_dict['es_merge_spec']['transPath'] = es_merging_trf_name
-                    name_postfix = ''
-                    if trf_release in ['20.3.7.5', '20.7.8.7']:
-                        name_postfix = '_000'
-                    task_proto_dict['es_merge_spec']['jobParameters'] = \
-                        '--AMITag {0} --DBRelease=current --autoConfiguration=everything '.format(
-                            es_merging_tag_name) + \
-                        '--outputHitsFile=${OUTPUT0} --inputHitsFile=@inputFor_${OUTPUT0}' + name_postfix
-
-            if project_mode.esConsumers is not None:
-                task_proto_dict['number_of_es_consumers'] = project_mode.esConsumers
-
-            if project_mode.esMaxAttempt is not None:
-                task_proto_dict['max_attempt_es'] = project_mode.esMaxAttempt
-
-            if project_mode.esMaxAttemptJob is not None:
-                task_proto_dict['max_attempt_es_job'] = project_mode.esMaxAttemptJob
-
-            if project_mode.nJumboJobs is not None:
-                task_proto_dict['number_of_jumbo_jobs'] = project_mode.nJumboJobs
-
-            if project_mode.nEventsPerOutputFile is not None:
-                task_proto_dict['number_of_events_per_output_file'] = project_mode.nEventsPerOutputFile
-
-            if project_mode.nEventsPerWorker:
-                task_proto_dict['number_of_events_per_worker'] = project_mode.nEventsPerWorker
-
-            if project_mode.processingType is not None:
-                task_proto_dict.update({'type': project_mode.processingType})
-
-            if project_mode.prodSourceLabel is not None:
-                task_proto_dict.update({'prod_source': project_mode.prodSourceLabel})
-
-            if project_mode.skipShortInput is not None:
-                task_proto_dict.update({'skip_short_input': project_mode.skipShortInput or None})
+                    task_proto_dict['es_merge_spec'] = self._get_es_merge_spec(ctag_name, trf_release)
 
-            if project_mode.skipShortOutput is not None:
-                task_proto_dict.update({'skip_short_output': project_mode.skipShortOutput or None})
-
-            if project_mode.registerEsFiles is not None:
-                task_proto_dict.update({'register_es_files': project_mode.registerEsFiles or None})
-
-            if project_mode.transUsesPrefix:
-                task_proto_dict.update({'trans_uses_prefix': project_mode.transUsesPrefix})
-
-            if project_mode.noWaitParent is not None:
-                task_proto_dict.update({'no_wait_parent': project_mode.noWaitParent or None})
-
-            if project_mode.usePrefetcher is not None:
-                task_proto_dict.update({'use_prefetcher': project_mode.usePrefetcher or None})
-
-            if project_mode.disableAutoFinish is not None:
-                task_proto_dict.update({'disable_auto_finish': project_mode.disableAutoFinish or None})
+            _apply_project_mode_options(project_mode, task_proto_dict)
 
             if project_mode.isMergeTask:
-                task_proto_dict.update({'use_exhausted': True})
-                task_proto_dict.update({'goal': str(100.0)})
-                task_proto_dict.update({'fail_when_goal_unreached': False})
-                task_proto_dict.update({'disable_auto_finish': True})
+                task_proto_dict.update({'use_exhausted': True, 'goal': str(100.0), 'fail_when_goal_unreached': False,
+                                        'disable_auto_finish': True})
 
             if project_mode.outDiskCount is not None:
                 task_proto_dict['out_disk_count'] = project_mode.outDiskCount
                 task_proto_dict['out_disk_unit'] = 'kB'
 
-            if project_mode.inFilePosEvtNum is not None:
-                task_proto_dict.update({'in_file_pos_evt_num': project_mode.inFilePosEvtNum or None})
-
-            if project_mode.tgtMaxOutputForNG is not None:
-                task_proto_dict.update({'tgt_max_output_for_ng': project_mode.tgtMaxOutputForNG})
-
-            if project_mode.maxWalltime is not None:
-                task_proto_dict.update({'max_walltime': project_mode.maxWalltime})
-
-            if project_mode.notDiscardEvents is not None:
-                task_proto_dict.update({'not_discard_events': project_mode.notDiscardEvents or None})
-
-            if project_mode.scoutSuccessRate is not None:
-                task_proto_dict.update({'scout_success_rate': project_mode.scoutSuccessRate})
-
             reuse_input = None
             if project_mode.reuseInput is not None:
                 if project_mode.reuseInput > 0:
                     reuse_input = project_mode.reuseInput
 
-            if project_mode.orderByLB is not None:
-                task_proto_dict.update({'order_by_lb': project_mode.orderByLB or None})
-
             truncate_output_formats = project_mode.truncateOutputFormats
 
-            if project_mode.useZipToPin is not None:
-                task_proto_dict.update({'use_zip_to_pin': project_mode.useZipToPin})
-
-            if project_mode.noLoopingCheck is not None:
-                task_proto_dict.update({'no_looping_check': project_mode.noLoopingCheck or None})
-
-            if project_mode.taskBrokerOnMaster is not None:
-                task_proto_dict.update({'task_broker_on_master': project_mode.taskBrokerOnMaster or None})
-
-            if project_mode.onSiteMerging is not None:
-                task_proto_dict.update({'on_site_merging': project_mode.onSiteMerging or None})
-
-            if project_mode.releasePerLB is not None:
-                task_proto_dict.update({'release_per_LB': project_mode.releasePerLB or None})
-
-            if project_mode.toStaging is not None:
-                task_proto_dict.update({'to_staging': project_mode.toStaging or None})
-
-            if project_mode.inputPreStaging is not None:
-                task_proto_dict.update({'input_pre_staging': project_mode.inputPreStaging or None})
-                
-            if project_mode.allowEmptyInput is not None:
-                task_proto_dict.update({'allow_empty_input': project_mode.allowEmptyInput or None})
-
-            if project_mode.fullChain is not None:
-                task_proto_dict.update({'full_chain': project_mode.fullChain or None})
-
-            if project_mode.orderInputBy is not None:
-                task_proto_dict.update({'order_input_by': project_mode.orderInputBy or None})
-
             if project_mode.nocvmfs is not None:
-                task_proto_dict.update({'multi_step_exec': {'containerOptions': {'execArgs': '--nocvmfs'}}})
+                task_proto_dict['multi_step_exec'] = {'containerOptions': {'execArgs': '--nocvmfs'}}
 
-            if project_mode.containerName is not None:
-                task_proto_dict.update({'container_name': project_mode.containerName or None})
+            number_of_jobs = 0
+            if number_of_events > 0 and 'nEventsPerJob' in task_config:
+                number_of_jobs = -(-int(number_of_events) // int(task_config['nEventsPerJob']))
 
-            if step.request.request_type.lower() == 'MC'.lower():
-                if 'nEventsPerJob' in list(task_config.keys()) and number_of_events > 0:
-                    number_of_jobs = int(number_of_events) / int(task_config['nEventsPerJob'])
+            if request_type == 'mc':
+                if number_of_jobs:
                     if number_of_jobs <= 10:
-                        task_proto_dict.update({'use_exhausted': True})
-                        task_proto_dict.update({'goal': str(100.0)})
-                        task_proto_dict.update({'fail_when_goal_unreached': False})
-                        task_proto_dict.update({'disable_auto_finish': True})
+                        task_proto_dict.update({'use_exhausted': True, 'goal': str(100.0), 'fail_when_goal_unreached': False,
+                                                'disable_auto_finish': True})
                     else:
                         if number_of_events <= 1000:
-                            task_proto_dict.update({'use_exhausted': True})
-                            task_proto_dict.update({'goal': str(100.0)})
-                            task_proto_dict.update({'fail_when_goal_unreached': True})
+                            task_proto_dict.update({'use_exhausted': True, 'goal': str(100.0), 'fail_when_goal_unreached': True})
             if not evgen_params:
                 self._check_number_of_events(step, project_mode)
 
-            if number_of_events > 0 and 'nEventsPerJob' in list(task_config.keys()):
-                number_of_jobs = number_of_events / int(task_config['nEventsPerJob'])
-                if number_of_jobs > TaskDefConstants.DEFAULT_MAX_NUMBER_OF_JOBS_PER_TASK:
-                    raise MaxJobsPerTaskLimitExceededException(number_of_jobs)
+            if number_of_jobs > TaskDefConstants.DEFAULT_MAX_NUMBER_OF_JOBS_PER_TASK:
+                raise MaxJobsPerTaskLimitExceededException(number_of_jobs)
 
             if project_mode.failWhenGoalUnreached is not None:
-                task_proto_dict.update({'fail_when_goal_unreached': project_mode.failWhenGoalUnreached or None})
+                task_proto_dict['fail_when_goal_unreached'] = project_mode.failWhenGoalUnreached or None
 
             io_intensity = None
 
-            if prod_step.lower() == 'merge'.lower():
-                if trf_name.lower() == 'ESDMerge_tf.py'.lower():
-                    io_intensity = 3000
-                elif trf_name.lower() == 'HISTMerge_tf.py'.lower():
-                    io_intensity = 2000
-                elif trf_name.lower() == 'EVNTMerge_tf.py'.lower():
-                    io_intensity = 4000
-                elif trf_name.lower() == 'HITSMerge_tf.py'.lower():
-                    io_intensity = 3000
-                elif trf_name.lower() == 'AODMerge_tf.py'.lower():
-                    io_intensity = 2000
-                elif trf_name.lower() == 'NTUPMerge_tf.py'.lower():
-                    io_intensity = 2000
-                elif trf_name.lower() == 'DAODMerge_tf.py'.lower():
-                    io_intensity = 2000
-                elif trf_name.lower() == 'RDOMerge_tf.py'.lower():
-                    io_intensity = 4000
-            elif prod_step.lower() == 'deriv'.lower():
-                if step.request.provenance.lower() == 'GP'.lower():
-                    if (trf_name.lower() == 'Reco_tf.py'.lower()) or (trf_name.lower() == 'Derivation_tf.py'.lower()):
+            if prod_step_name == 'merge':
+                io_intensity = _MERGE_IO_INTENSITY.get(trf_name_lower)
+            elif prod_step_name == 'deriv':
+                if step.request.provenance.lower() == 'gp':
+                    if (trf_name_lower == 'reco_tf.py') or (trf_name_lower == 'derivation_tf.py'):
                         io_intensity = 500
                 if re.match('^AP_(?!SOFT|REPR|UPG|THLT|VALI).*$', usergroup, re.IGNORECASE):
-                    if trf_name.lower() == 'Reco_tf.py'.lower():
+                    if trf_name_lower == 'reco_tf.py':
                         io_intensity = 5000
-                    if trf_name.lower() == 'PRWConfig_tf.py'.lower():
+                    if trf_name_lower == 'prwconfig_tf.py':
                         io_intensity = 5000
-            if trf_name.lower() == 'Archive_tf.py'.lower():
+            if trf_name_lower == 'archive_tf.py':
                 io_intensity = 5000
 
             if io_intensity:
-                task_proto_dict.update({'io_intensity': int(io_intensity)})
-                task_proto_dict.update({'io_intensity_unit': 'kBPerS'})
+                task_proto_dict['io_intensity'] = int(io_intensity)
+                task_proto_dict['io_intensity_unit'] = 'kBPerS'
             #Set GShare
             if usergroup in ['AP_VALI','GP_VALI']:
                 if not project_mode.gshare:
-                    task_proto_dict.update({'global_share': 'Validation'})
+                    task_proto_dict['global_share'] = 'Validation'
             # test Event Service
             if project_mode.testES:
                 if project_mode.nEventsPerWorker:
@@ -4370,45 +4410,37 @@ class TaskDefinition(object):
                     task_proto_dict['type'] = project_mode.esProcessingType
                 if project_mode.maxAttemptES is not None:
                     task_proto_dict['max_attempt_es'] = project_mode.maxAttemptES
-                task_proto_dict['es_merge_spec'] = {}
-                task_proto_dict['es_merge_spec']['transPath'] = 'HITSMerge_tf.py'
-                name_postfix = ''
-                if trf_release in ['20.3.7.5', '20.7.8.7']:
-                    name_postfix = "_000"
-                task_proto_dict['es_merge_spec']['jobParameters'] = \
-                    "--AMITag s2049 --DBRelease=current --autoConfiguration=everything " \
-                    "--outputHitsFile=${OUTPUT0} --inputHitsFile=@inputFor_${OUTPUT0}" + name_postfix
+                task_proto_dict['es_merge_spec'] = self._get_es_merge_spec('s2049', trf_release)
 
             if not use_real_nevents and \
-                    'number_of_events_per_input_file' not in list(task_proto_dict.keys()) and \
-                    'number_of_gb_per_job' not in list(task_proto_dict.keys()) and \
-                    'tgt_max_output_for_ng' not in list(task_proto_dict.keys()):
-                if 'number_of_files_per_job' not in list(task_proto_dict.keys()) and not project_mode.onSiteMerging:
-                    task_proto_dict.update({'number_of_files_per_job': 1})
+                    'number_of_events_per_input_file' not in task_proto_dict and \
+                    'number_of_gb_per_job' not in task_proto_dict and \
+                    'tgt_max_output_for_ng' not in task_proto_dict:
+                if 'number_of_files_per_job' not in task_proto_dict and not project_mode.onSiteMerging:
+                    task_proto_dict['number_of_files_per_job'] = 1
 
-            if 'number_of_gb_per_job' in list(task_proto_dict.keys()) or 'tgt_max_output_for_ng' in list(
-                    task_proto_dict.keys()):
-                if 'respect_split_rule' not in list(task_proto_dict.keys()):
-                    task_proto_dict.update({'respect_split_rule': True})
+            if 'number_of_gb_per_job' in task_proto_dict or 'tgt_max_output_for_ng' in task_proto_dict:
+                if 'respect_split_rule' not in task_proto_dict:
+                    task_proto_dict['respect_split_rule'] = True
 
             if use_real_nevents:
-                if 'number_of_max_files_per_job' not in list(task_proto_dict.keys()):
-                    task_proto_dict.update({'number_of_max_files_per_job': 200})
+                if 'number_of_max_files_per_job' not in task_proto_dict:
+                    task_proto_dict['number_of_max_files_per_job'] = 200
 
-            if 'number_of_gb_per_job' in list(task_proto_dict.keys()):
+            if 'number_of_gb_per_job' in task_proto_dict:
                 if not project_mode.nMaxFilesPerJob:
-                    task_proto_dict.update({'number_of_max_files_per_job': 1000})
+                    task_proto_dict['number_of_max_files_per_job'] = 1000
 
-            if use_real_nevents and 'number_of_events_per_input_file' in list(task_proto_dict.keys()):
+            if use_real_nevents and 'number_of_events_per_input_file' in task_proto_dict:
                 raise TaskConfigurationException(
                     "The task is rejected due to incompatible parameters: useRealNumEvents, 'Events per Input file'"
                 )
-            if is_pile_task and (not use_real_nevents) and (not ('number_of_events_per_input_file' in list(task_proto_dict.keys()))):
+            if is_pile_task and (not use_real_nevents) and ('number_of_events_per_input_file' not in task_proto_dict):
                 raise TaskConfigurationException(
                     "The task is rejected - pile tasks required  Events per Input file or useRealNumEvents to be set"
                 )
 
-            if (prod_step.lower() == 'simul'.lower()and (not use_real_nevents) and (not ('number_of_events_per_input_file' in list(task_proto_dict.keys()))) and
+            if (prod_step_name == 'simul' and (not use_real_nevents) and ('number_of_events_per_input_file' not in task_proto_dict) and
                     not project_mode.noInputSimul):
                 raise TaskConfigurationException(
                     "The task is rejected - simul tasks required  Events per Input file or useRealNumEvents to be set"
@@ -4427,66 +4459,60 @@ class TaskDefinition(object):
             task_proto = self.protocol.render_task(task_proto_dict)
 
             task_elements = list()
+            task_proto_id_string = TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id
 
             input_file_dict = dict()
-            for key in list(input_params.keys()):
-                if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
-                    input_file_dict.update({key: input_params[key]})
-
-            if len(list(input_file_dict.keys())):
-                input_list_length = len(input_file_dict[list(input_file_dict.keys())[0]])
-                all_lists = [input_file_dict[key] for key in list(input_file_dict.keys())]
-                if any(len(input_list) != input_list_length for input_list in all_lists):
+            for key, value in input_params.items():
+                if _INPUT_FILE_PARAM_RE.match(key):
+                    input_file_dict.update({key: value})
+
+            if input_file_dict:
+                input_list_lengths = {len(input_list) for input_list in input_file_dict.values()}
+                if len(input_list_lengths) != 1:
                     raise Exception("Input lists are different lengths")
-                context_dict_list = list()
-                for i in range(input_list_length):
-                    context_dict = dict()
-                    for key in list(input_file_dict.keys()):
-                        context_dict.update({"%s_dataset" % key: input_file_dict[key][i]})
-                    if len(list(context_dict.keys())):
-                        context_dict_list.append(context_dict)
-                for context_dict in context_dict_list:
-                    template_string = self.protocol.serialize_task(task_proto)
-                    task_template = Template(template_string)
+                context_keys = ["%s_dataset" % key for key in input_file_dict]
+                context_dict_list = [dict(zip(context_keys, input_row))
+                                     for input_row in zip(*input_file_dict.values())]
+                task_template = Template(self.protocol.serialize_task(task_proto))
+                if not self.template_type:
+                    task_id_list = self.task_reg.register_task_ids(len(context_dict_list))
+                else:
+                    task_id_list = [task_proto_id] * len(context_dict_list)
+                for context_dict, task_id in zip(context_dict_list, task_id_list):
                     task_string = task_template.render(Context(context_dict))
-                    if not self.template_type:
-                        task_id = self.task_reg.register_task_id()
-                    else:
-                        task_id = task_proto_id
-                    task_string = task_string.replace(TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id,
+                    task_string = task_string.replace(task_proto_id_string,
                                                       TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id)
 
                     task = self.protocol.deserialize_task(task_string)
                     task_elements.append({task_id: task})
             else:
-                task_string = self.protocol.serialize_task(task_proto)
                 if not self.template_type:
                     task_id = self.task_reg.register_task_id()
                 else:
                     task_id = task_proto_id
-                task_string = task_string.replace(TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id,
-                                                  TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id)
-                task = self.protocol.deserialize_task(task_string)
+                task = self._replace_task_id(task_proto, task_proto_id_string,
+                                             TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id)
                 task_elements.append({task_id: task})
 
             if not len(task_elements):
                 raise Exception("Input container doesn't exist or empty")
 
+            check_number_of_jobs = request_type == 'mc' and prod_step_name == 'simul' and \
+                int(trf_release.split('.', 1)[0]) >= 21 and not project_mode.onSiteMerging and \
+                not project_mode.noInputSimul
+
             for task_element in task_elements:
-                task_id = list(task_element.keys())[0]
-                task = list(task_element.values())[0]
-
-                for key in list(output_params.keys()):
-                    for output_dataset_name in output_params[key]:
-                        output_dataset_name = output_dataset_name.replace(
-                            TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id,
-                            TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id)
+                (task_id, task), = task_element.items()
+                task_id_string = TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id
+
+                for output_dataset_names in output_params.values():
+                    for output_dataset_name in output_dataset_names:
+                        output_dataset_name = output_dataset_name.replace(task_proto_id_string, task_id_string)
                         if len(output_dataset_name) > TaskDefConstants.DEFAULT_OUTPUT_NAME_MAX_LENGTH:
                             raise OutputNameMaxLengthException(output_dataset_name)
 
-                if step.request.request_type.lower() == 'MC'.lower():
-                    if prod_step.lower() == 'simul'.lower() and int(trf_release.split('.')[0]) >= 21 and not project_mode.onSiteMerging and not project_mode.noInputSimul:
-                        self._check_task_number_of_jobs(task, number_of_events, step)
+                if check_number_of_jobs:
+                    self._check_task_number_of_jobs(task, number_of_events, step)
 
                 self._check_task_unmerged_input(task, step, prod_step)
                 self._check_task_merged_input(task, step, prod_step)
@@ -4563,94 +4589,84 @@ class TaskDefinition(object):
                         logger.error('Problem with hashtag registration {0}'.format(str(e)))
                 parent_task_id = task_id
 
+    @staticmethod
+    def _get_slice_input_q(input_data_name):
+        input_data_name_no_scope = input_data_name.split(':')[-1]
+        return Q(step__slice__input_dataset=input_data_name) | \
+            Q(step__slice__input_dataset__endswith=input_data_name_no_scope) | \
+            Q(step__slice__input_data=input_data_name) | \
+            Q(step__slice__input_data__endswith=input_data_name_no_scope)
+
+    def _get_previous_step_tasks(self, step, input_q, split_slice):
+        previous_tasks = ProductionTask.objects.filter(
+            ~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) & input_q,
+            project=step.request.project,
+            step__step_template__ctag=step.step_template.ctag)
+        if split_slice:
+            # output formats are compared by the caller
+            return previous_tasks.select_related('step__step_template')
+        return previous_tasks.filter(step__step_template__output_formats=step.step_template.output_formats)
+
     def _get_number_events_processed(self, step, requested_datasets=None):
         number_events_processed = 0
         tasks = []
         input_data_name = self.get_step_input_data_name(step)
-        project_mode = ProjectMode(step)
-
-        ps1_task_list = TTaskRequest.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete']),
-                                                    project=step.request.project,
-                                                    inputdataset=input_data_name,
-                                                    ctag=step.step_template.ctag,
-                                                    formats=step.step_template.output_formats)
-        for ps1_task in ps1_task_list:
-            number_events_processed += int(ps1_task.total_events or 0)
-
-        split_slice = ProjectMode.get_task_config(step).get('split_slice')
-
+        project_mode = self._get_project_mode_cached(step)
+
+        ps1_total_events = TTaskRequest.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete']),
+                                                       project=step.request.project,
+                                                       inputdataset=input_data_name,
+                                                       ctag=step.step_template.ctag,
+                                                       formats=step.step_template.output_formats).aggregate(
+            total_events=Sum('total_events'))['total_events']
+        number_events_processed += int(ps1_total_events or 0)
+
+        split_slice = project_mode.task_config.get('split_slice')
+        ps2_task_fields = ('id', 'parent_id', 'total_events', 'total_req_events')
         if split_slice:
-            ps2_task_list = list(
-                ProductionTask.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                                              (Q(step__slice__input_dataset=input_data_name) |
-                                               Q(step__slice__input_dataset__endswith=input_data_name.split(':')[-1]) |
-                                               Q(step__slice__input_data=input_data_name) |
-                                               Q(step__slice__input_data__endswith=input_data_name.split(':')[-1])),
-                                              project=step.request.project,
-                                              step__step_template__ctag=step.step_template.ctag))
-            # check child
-            child_tasks = []
-            for dataset in requested_datasets or []:
-                child_tasks += list(ProductionTask.objects.filter(
-                    ~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                    (Q(inputdataset=dataset) |
-                     Q(inputdataset__endswith=dataset.split(':')[-1])),
-                    project=step.request.project,
-                    step__step_template__ctag=step.step_template.ctag))
-            ps2_task_list += [x for x in child_tasks if x not in ps2_task_list]
-        else:
-            ps2_task_list = \
-                list(ProductionTask.objects.filter(
-                    ~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                    (Q(step__slice__input_dataset=input_data_name) |
-                     Q(step__slice__input_dataset__endswith=input_data_name.split(':')[-1]) |
-                     Q(step__slice__input_data=input_data_name) |
-                     Q(step__slice__input_data__endswith=input_data_name.split(':')[-1])),
-                    project=step.request.project,
-                    step__step_template__ctag=step.step_template.ctag,
-                    step__step_template__output_formats=step.step_template.output_formats))
-
-            # check child
-            child_tasks = []
-            for dataset in requested_datasets or []:
-                child_tasks += list(ProductionTask.objects.filter(
-                    ~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                    (Q(inputdataset=dataset) |
-                     Q(inputdataset__endswith=dataset.split(':')[-1])),
-                    project=step.request.project,
-                    step__step_template__ctag=step.step_template.ctag,
-                    step__step_template__output_formats=step.step_template.output_formats))
-            ps2_task_list += [x for x in child_tasks if x not in ps2_task_list]
+            ps2_task_fields += ('step__step_template__output_formats',)
+
+        ps2_task_list = list(self._get_previous_step_tasks(
+            step, self._get_slice_input_q(input_data_name), split_slice).only(*ps2_task_fields))
+        # check child
+        child_tasks = []
+        for dataset in requested_datasets or []:
+            child_tasks += list(self._get_previous_step_tasks(
+                step, Q(inputdataset=dataset) | Q(inputdataset__endswith=dataset.split(':')[-1]),
+                split_slice).only(*ps2_task_fields))
+        ps2_task_ids = {x.id for x in ps2_task_list}
+        ps2_task_list += [x for x in child_tasks if x.id not in ps2_task_ids]
+
+        jedi_tasks_existing = TTask.objects.filter(id__in=[ps2_task.id for ps2_task in ps2_task_list]).only(
+            'id', 'jedi_task_param').in_bulk()
+        requested_datasets_no_scope = {e.split(':')[-1] for e in requested_datasets or []}
+        requested_output_types = step.step_template.output_formats.split('.')
+        requested_output_types_set = set(requested_output_types)
 
         max_by_offset = 0
         for ps2_task in ps2_task_list:
 
             if split_slice:
                 # comparing output formats
-                requested_output_types = step.step_template.output_formats.split('.')
-                previous_output_types = ps2_task.step.step_template.output_formats.split('.')
-                processed_output_types = [e for e in requested_output_types if e in previous_output_types]
-                if not processed_output_types:
+                if requested_output_types_set.isdisjoint(ps2_task.step.step_template.output_formats.split('.')):
                     continue
 
-            jedi_task_existing = TTask.objects.get(id=ps2_task.id)
+            jedi_task_existing = jedi_tasks_existing[ps2_task.id]
+            task_existing = json.loads(jedi_task_existing.jedi_task_param)
 
             previous_dsn = None
             if requested_datasets:
-                task_existing = json.loads(jedi_task_existing.jedi_task_param)
                 previous_dsn = self._get_primary_input(task_existing['jobParameters'])['dataset']
-                requested_datasets_no_scope = [e.split(':')[-1] for e in requested_datasets]
                 previous_dsn_no_scope = previous_dsn.split(':')[-1]
                 if previous_dsn_no_scope not in requested_datasets_no_scope:
                     continue
 
             if project_mode.checkOutputDeleted:
-                requested_output_types = step.step_template.output_formats.split('.')
                 previous_output_status_dict = \
                     self.task_reg.check_task_output(ps2_task.id, requested_output_types)
                 previous_output_exists = False
                 for requested_output_type in requested_output_types:
-                    if requested_output_type not in list(previous_output_status_dict.keys()):
+                    if requested_output_type not in previous_output_status_dict:
                         continue
                     if previous_output_status_dict[requested_output_type]:
                         previous_output_exists = True
@@ -4666,7 +4682,7 @@ class TaskDefinition(object):
                     number_events = self.rucio_client.get_number_events(previous_dsn)
                 number_events = max(ps2_task.total_events, number_events)
             number_events_processed += number_events
-            offset = jedi_task_existing.get_job_parameter('firstEvent', 'offset')
+            offset = jedi_task_existing.get_job_parameter('firstEvent', 'offset', task_existing)
             if offset and offset > 0:
                 max_by_offset = max(max_by_offset, number_events + offset)
 
@@ -4677,41 +4693,26 @@ class TaskDefinition(object):
         input_data_name = self.get_step_input_data_name(step)
         split_slice = ProjectMode.get_task_config(step).get('split_slice')
 
-        if split_slice:
-            ps2_task_list = \
-                ProductionTask.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                                              (Q(step__slice__input_dataset=input_data_name) |
-                                               Q(step__slice__input_dataset__endswith=input_data_name.split(':')[-1]) |
-                                               Q(step__slice__input_data=input_data_name) |
-                                               Q(step__slice__input_data__endswith=input_data_name.split(':')[-1])),
-                                              project=step.request.project,
-                                              step__step_template__ctag=step.step_template.ctag)
-        else:
-            ps2_task_list = \
-                ProductionTask.objects.filter(~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
-                                              (Q(step__slice__input_dataset=input_data_name) |
-                                               Q(step__slice__input_dataset__endswith=input_data_name.split(':')[-1]) |
-                                               Q(step__slice__input_data=input_data_name) |
-                                               Q(step__slice__input_data__endswith=input_data_name.split(':')[-1]) |
-                                               Q(inputdataset=input_data_name) |
-                                               Q(inputdataset__endswith=input_data_name.split(':')[-1])),
-                                              project=step.request.project,
-                                              step__step_template__ctag=step.step_template.ctag,
-                                              step__step_template__output_formats=step.step_template.output_formats)
+        input_q = self._get_slice_input_q(input_data_name)
+        if not split_slice:
+            input_q |= Q(inputdataset=input_data_name) | Q(inputdataset__endswith=input_data_name.split(':')[-1])
+        ps2_task_list = self._get_previous_step_tasks(step, input_q, split_slice)
 
-        for ps2_task in ps2_task_list:
+        ps2_task_list = list(ps2_task_list.values_list('id', 'step__step_template__output_formats'))
+        jedi_tasks_existing = TTask.objects.filter(id__in=[ps2_task_id for ps2_task_id, _ in ps2_task_list]).only(
+            'id', 'jedi_task_param').in_bulk()
+        requested_datasets_no_scope = {e.split(':')[-1] for e in requested_datasets or []}
+        requested_output_types_set = set(step.step_template.output_formats.split('.'))
+
+        for ps2_task_id, ps2_task_output_formats in ps2_task_list:
 
             if split_slice:
                 # comparing output formats
-                requested_output_types = step.step_template.output_formats.split('.')
-                previous_output_types = ps2_task.step.step_template.output_formats.split('.')
-                processed_output_types = [e for e in requested_output_types if e in previous_output_types]
-                if not processed_output_types:
+                if requested_output_types_set.isdisjoint(ps2_task_output_formats.split('.')):
                     continue
-            jedi_task_existing = TTask.objects.get(id=ps2_task.id)
+            jedi_task_existing = jedi_tasks_existing[ps2_task_id]
             task_existing = json.loads(jedi_task_existing.jedi_task_param)
             previous_dsn = self._get_primary_input(task_existing['jobParameters'])['dataset']
-            requested_datasets_no_scope = [e.split(':')[-1] for e in requested_datasets]
             previous_dsn_no_scope = previous_dsn.split(':')[-1]
             if requested_datasets:
                 if previous_dsn_no_scope not in requested_datasets_no_scope:
@@ -4719,8 +4720,11 @@ class TaskDefinition(object):
             processed_datasets.append(previous_dsn_no_scope)
         return processed_datasets
 
-    def get_events_per_file(self, input_name):
+    def get_events_per_file(self, input_name, number_files_and_events=None):
         nevents_per_file = 0
+        if number_files_and_events and number_files_and_events[0]:
+            number_files, number_events = number_files_and_events
+            return -(-number_events // number_files)
         try:
             try:
                 nevents_per_file = self.rucio_client.get_nevents_per_file(input_name)
@@ -4730,77 +4734,163 @@ class TaskDefinition(object):
             logger.info("get_nevents_per_file, exception occurred: %s" % get_exception_string())
         return nevents_per_file
 
-    def get_events_per_input_file(self, step, input_name, use_real_events=False):
+    def get_events_per_input_file(self, step, input_name, use_real_events=False, number_files_and_events=None):
         task_config = ProjectMode.get_task_config(step)
-        if 'nEventsPerInputFile' not in list(task_config.keys()) or use_real_events:
-            events_per_file = int(self.get_events_per_file(input_name))
+        if 'nEventsPerInputFile' not in task_config or use_real_events:
+            events_per_file = int(self.get_events_per_file(input_name, number_files_and_events))
         else:
             events_per_file = int(task_config['nEventsPerInputFile'])
         return events_per_file
 
-    def get_events_in_datasets(self, datasets, step, use_real_events=False):
+    def get_events_per_input_file_map(self, step, datasets, use_real_events=False, datasets_files_and_events=None):
+        task_config = ProjectMode.get_task_config(step)
+        if 'nEventsPerInputFile' in task_config and not use_real_events:
+            return dict.fromkeys(datasets, int(task_config['nEventsPerInputFile']))
+        if datasets_files_and_events is None:
+            datasets_files_and_events = dict()
+        return {dataset_name: int(self.get_events_per_file(dataset_name, datasets_files_and_events.get(dataset_name)))
+                for dataset_name in datasets}
+
+    def get_number_files_and_events_bulk(self, datasets):
+        try:
+            return self.rucio_client.get_number_files_and_events_bulk(datasets)
+        except Exception as ex:
+            logger.warning('get_number_files_and_events_bulk failed, datasets are checked one by one: {0}'.format(
+                str(ex)))
+            return dict()
+
+    def _get_number_files_and_events(self, dataset_name, datasets_files_and_events, with_events=True):
+        number_files_and_events = datasets_files_and_events.get(dataset_name)
+        if number_files_and_events is None:
+            # the file count is cached on its own, the event count is asked from Rucio only when needed
+            number_files = self._get_number_files_cached(dataset_name)
+            if not with_events:
+                return number_files, None
+            number_files_and_events = number_files, self.rucio_client.get_number_events(dataset_name)
+            datasets_files_and_events[dataset_name] = number_files_and_events
+        return number_files_and_events
+
+    def get_events_in_datasets(self, datasets, step, use_real_events=False, datasets_files_and_events=None,
+                               events_per_file_map=None):
         number_events = 0
+        if datasets_files_and_events is None:
+            datasets_files_and_events = self.get_number_files_and_events_bulk(datasets)
+        if events_per_file_map is None:
+            events_per_file_map = self.get_events_per_input_file_map(step, datasets, use_real_events=use_real_events,
+                                                                     datasets_files_and_events=datasets_files_and_events)
         for dataset_name in datasets:
-            events_per_file = self.get_events_per_input_file(step, dataset_name, use_real_events=use_real_events)
-            number_events_in_dataset = events_per_file * self.rucio_client.get_number_files(dataset_name)
+            number_files, number_events_in_rucio_dataset = \
+                self._get_number_files_and_events(dataset_name, datasets_files_and_events,
+                                                  with_events=use_real_events)
+            events_per_file = events_per_file_map[dataset_name]
+            number_events_in_dataset = events_per_file * number_files
             if use_real_events:
-                number_events_in_rucio_dataset = self.rucio_client.get_number_events(dataset_name)
                 if number_events_in_rucio_dataset > 0:
                     number_events_in_dataset = min(number_events_in_dataset, number_events_in_rucio_dataset)
             number_events += number_events_in_dataset
         return number_events
 
+    def _get_sc_hashtags(self):
+        try:
+            return self._sc_hashtags
+        except AttributeError:
+            pass
+        # sub-campaign hashtag -> hashtag id, in the order of DEFAULT_SC_HASHTAGS
+        sc_hashtag_names = [e + TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX for e, _ in _SC_HASHTAG_PATTERNS]
+        existing_hashtags = dict(HashTag.objects.filter(hashtag__in=sc_hashtag_names).values_list('hashtag', 'id'))
+        sc_hashtags = dict()
+        for e in sc_hashtag_names:
+            if e not in existing_hashtags:
+                hashtag = HashTag(hashtag=e, type='UD')
+                hashtag.save()
+                existing_hashtags[e] = hashtag.id
+            sc_hashtags[e] = existing_hashtags[e]
+        self._sc_hashtags = sc_hashtags
+        return sc_hashtags
+
+    def _prefetch_dataset_subcampaigns(self, names):
+        # resolve datasets whose parent tasks are already tagged with a sub-campaign hashtag in two queries,
+        # the rest is left to get_dataset_subcampaign
+        try:
+            subcampaign_cache = self._subcampaign_cache
+        except AttributeError:
+            subcampaign_cache = self._subcampaign_cache = dict()
+        task_id_by_name = dict()
+        for name in names:
+            if name in subcampaign_cache:
+                continue
+            try:
+                task_id = self._get_parent_task_id_from_input(name)
+            except Exception:
+                continue
+            if task_id == 0:
+                subcampaign_cache[name] = None
+            else:
+                task_id_by_name[name] = task_id
+        if not task_id_by_name:
+            return
+        sc_hashtags = self._get_sc_hashtags()
+        task_hashtags = dict()
+        for task_id, hashtag_id in HashTagToTask.objects.filter(
+                task_id__in=set(task_id_by_name.values()),
+                hashtag_id__in=list(sc_hashtags.values())).values_list('task_id', 'hashtag_id'):
+            task_hashtags.setdefault(int(task_id), set()).add(hashtag_id)
+        for name, task_id in task_id_by_name.items():
+            hashtag_ids = task_hashtags.get(task_id)
+            if not hashtag_ids:
+                continue
+            for e, hashtag_id in sc_hashtags.items():
+                if hashtag_id in hashtag_ids:
+                    subcampaign_cache[name] = e.split(TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX)[0]
+                    break
+
     def get_dataset_subcampaign(self, name):
+        try:
+            if name in self._subcampaign_cache:
+                return self._subcampaign_cache[name]
+        except AttributeError:
+            self._subcampaign_cache = dict()
+        subcampaign = self._get_dataset_subcampaign(name)
+        self._subcampaign_cache[name] = subcampaign
+        return subcampaign
+
+    def _get_dataset_subcampaign(self, name):
         task_id = self._get_parent_task_id_from_input(name)
         if task_id == 0:
             return None
 
-        tasks = ProductionTask.objects.filter(id=task_id)
-        if not tasks:
-            subcampaign = self.rucio_client.get_campaign(name)
-            for e in list(TaskDefConstants.DEFAULT_SC_HASHTAGS.keys()):
-                for pattern in TaskDefConstants.DEFAULT_SC_HASHTAGS[e]:
-                    result = re.match(r'{0}'.format(pattern), subcampaign)
-                    if result:
-                        return e
+        task = ProductionTask.objects.filter(id=task_id).only('id').first()
+        if task is None:
+            return _match_subcampaign(self.rucio_client.get_campaign(name))
 
-        task = tasks[0]
-        sc_hashtags = \
-            [e + TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX for e in list(TaskDefConstants.DEFAULT_SC_HASHTAGS.keys())]
-        for e in sc_hashtags:
-            try:
-                hashtag = HashTag.objects.get(hashtag=e)
-            except ObjectDoesNotExist:
-                hashtag = HashTag(hashtag=e, type='UD')
-                hashtag.save()
-            if task.hashtag_exists(hashtag):
+        for e in self._get_sc_hashtags():
+            if task.hashtag_exists(e):
                 return e.split(TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX)[0]
 
-        subcampaign = self.rucio_client.get_campaign(name)
-        for e in list(TaskDefConstants.DEFAULT_SC_HASHTAGS.keys()):
-            for pattern in TaskDefConstants.DEFAULT_SC_HASHTAGS[e]:
-                result = re.match(r'{0}'.format(pattern), subcampaign)
-                if result:
-                    hashtag = HashTag.objects.get(hashtag=e + TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX)
-                    task.set_hashtag(hashtag)
-                    return e
+        sub_campaign = _match_subcampaign(self.rucio_client.get_campaign(name))
+        if sub_campaign:
+            task.set_hashtag(sub_campaign + TaskDefConstants.DEFAULT_SC_HASHTAG_SUFFIX)
+            return sub_campaign
 
         return None
 
     def verify_container_consistency(self, input_name):
-        if not self.rucio_client.is_dsn_container(input_name):
+        if not self._is_dsn_container_cached(input_name):
             return True
 
         dataset_list = list()
-        result = self.rucio_client.get_datasets_and_containers(input_name, datasets_contained_only=True)
+        result = self._get_datasets_and_containers_cached(input_name, datasets_contained_only=True)
         dataset_list.extend(result['datasets'])
+        if len(dataset_list) < 2:
+            return True
 
         previous_events_per_file = 0
+        datasets_files_and_events = self.get_number_files_and_events_bulk(dataset_list)
 
         for dataset_name in dataset_list:
-            number_files = self.rucio_client.get_number_files(dataset_name)
-            number_events = self.rucio_client.get_number_events(dataset_name)
-            events_per_file = math.ceil(float(number_events) / float(number_files))
+            number_files, number_events = \
+                self._get_number_files_and_events(dataset_name, datasets_files_and_events)
+            events_per_file = -(-number_events // number_files)
             if previous_events_per_file == 0:
                 previous_events_per_file = events_per_file
             else:
@@ -4817,25 +4907,26 @@ class TaskDefinition(object):
         if data_type in ['TXT']:
             return
 
-        task_config = ProjectMode.get_task_config(step)
-        project_mode = ProjectMode(step)
-        config_events_per_file = int(task_config.get('nEventsPerInputFile', 0))
+        project_mode = self._get_project_mode_cached(step)
+        config_events_per_file = int(project_mode.task_config.get('nEventsPerInputFile', 0))
         if not config_events_per_file:
             return
         dataset_list = list()
 
-        if self.rucio_client.is_dsn_container(input_name):
-            result = self.rucio_client.get_datasets_and_containers(input_name, datasets_contained_only=True)
+        if self._is_dsn_container_cached(input_name):
+            result = self._get_datasets_and_containers_cached(input_name, datasets_contained_only=True)
             dataset_list.extend(result['datasets'])
         else:
             dataset_list.append(input_name)
 
+        datasets_files_and_events = self.get_number_files_and_events_bulk(dataset_list)
+
         for dataset_name in dataset_list:
             events_per_file = 0
-            number_files = self.rucio_client.get_number_files(dataset_name)
-            number_events = self.rucio_client.get_number_events(dataset_name)
+            number_files, number_events = \
+                self._get_number_files_and_events(dataset_name, datasets_files_and_events)
             if number_events > 0:
-                events_per_file = math.ceil(float(number_events) / float(number_files))
+                events_per_file = -(-number_events // number_files)
 
             if not events_per_file:
                 continue
@@ -4843,7 +4934,7 @@ class TaskDefinition(object):
             parent_events_per_job = 0
             parent_task_id = 0
             try:
-                result = re.match(r'^.+_tid(?P<tid>\d+)_00$', dataset_name)
+                result = _TID_DATASET_RE.match(dataset_name)
                 if result:
                     parent_task = ProductionTask.objects.get(id=int(result.groupdict()['tid']))
                     parent_task_id = int(parent_task.id)
@@ -4860,30 +4951,28 @@ class TaskDefinition(object):
     def _get_splitting_dict(self, step):
         # splitting chains
         splitting_dict = dict()
-        if step.request.request_type.lower() in ['MC'.lower(), 'GROUP'.lower()]:
+        request_type = step.request.request_type.lower()
+        if request_type in ['mc', 'group']:
             ctag = self._get_ami_tag_cached(step.step_template.ctag)
             prod_step = self._get_prod_step(step.step_template.ctag, ctag)
-            project_mode = ProjectMode(step)
+            task_config = ProjectMode.get_task_config(step)
+            project_mode = self._get_project_mode_cached(step)
             is_none_campaign = False
-            prod_steps = list()
+            prod_steps = set()
             campaigns = dict()
 
             input_data_name = self.get_step_input_data_name(step)
             if not self.is_new_jo_format(input_data_name):
-                result = self.rucio_client.get_datasets_and_containers(input_data_name, datasets_contained_only=True)
+                result = self._get_datasets_and_containers_cached(input_data_name, datasets_contained_only=True)
             else:
                 result = {'datasets': []}
+            self._prefetch_dataset_subcampaigns(result['datasets'])
             for name in result['datasets']:
                 try:
-                    name_dict = self.parse_data_name(name)
-                    name_prod_step = name_dict['prod_step']
-                    if name_prod_step not in prod_steps:
-                        prod_steps.append(name_prod_step)
+                    prod_steps.add(self.parse_data_name(name)['prod_step'])
                     campaign = self.get_dataset_subcampaign(name)
                     if campaign:
-                        if campaign not in list(campaigns.keys()):
-                            campaigns[campaign] = list()
-                        campaigns[campaign].append(name)
+                        campaigns.setdefault(campaign, list()).append(name)
                     else:
                         if ('val' not in name) and (name.startswith('mc')) and (name[:4] > 'mc15'):
                             is_none_campaign = True
@@ -4891,7 +4980,6 @@ class TaskDefinition(object):
                     raise Exception(
                         'Processing of sub-campaign/campaign or production step failed: {0}'.format(str(ex)))
             if len(prod_steps) > 1:
-                task_config = ProjectMode.get_task_config(step)
                 task_config_changed = False
                 if not project_mode.forceSplitInput:
                     task_config['project_mode'] = 'forceSplitInput=yes;{0}'.format(task_config.get('project_mode', ''))
@@ -4901,25 +4989,24 @@ class TaskDefinition(object):
                     task_config_changed = True
                 if task_config_changed:
                     ProjectMode.set_task_config(step, task_config, keys_to_save=('project_mode',))
-                    project_mode = ProjectMode(step)
-            if len(list(campaigns.keys())) >= 1:
+                    project_mode = self._get_project_mode_cached(step)
+            if len(campaigns) >= 1:
                 if not project_mode.forceSplitInput:
-                    task_config = ProjectMode.get_task_config(step)
                     task_config['project_mode'] = 'forceSplitInput=yes;{0}'.format(task_config.get('project_mode', ''))
                     ProjectMode.set_task_config(step, task_config, keys_to_save=('project_mode',))
-                    project_mode = ProjectMode(step)
+                    project_mode = self._get_project_mode_cached(step)
                 if project_mode.runOnlyCampaign:
                     if is_none_campaign:
                         raise Exception('some of dataset has no sub-campaign/campaign, please contact MC coordinators')
                     requested_campaigns = list()
                     for value in project_mode.runOnlyCampaign.split(','):
-                        for e in list(TaskDefConstants.DEFAULT_SC_HASHTAGS.keys()):
-                            for pattern in TaskDefConstants.DEFAULT_SC_HASHTAGS[e]:
-                                if re.match(r'{0}'.format(pattern), value) and (e not in requested_campaigns):
+                        for e, patterns in _SC_HASHTAG_PATTERNS:
+                            for pattern in patterns:
+                                if pattern.match(value) and (e not in requested_campaigns):
                                     requested_campaigns.append(e)
                     requested_datasets = list()
                     for requested_campaign in requested_campaigns:
-                        if requested_campaign in list(campaigns.keys()):
+                        if requested_campaign in campaigns:
                             requested_datasets.extend(campaigns[requested_campaign])
                     if len(requested_datasets) > 0:
                         result['datasets'] = requested_datasets
@@ -4928,13 +5015,12 @@ class TaskDefinition(object):
                 else:
                     requested_campaign = str(step.request.subcampaign)
                     requested_campaign = requested_campaign.replace('MC20','MC16')
-                    if (requested_campaign.lower().startswith('MC16'.lower()) or  requested_campaign.lower().startswith('MC23'.lower())) and \
-                            step.request.request_type.lower() == 'MC'.lower():
+                    if requested_campaign.lower().startswith(('mc16', 'mc23')) and request_type == 'mc':
                         if is_none_campaign:
                             raise Exception(
                                 'some of dataset has no sub-campaign/campaign, please contact MC coordinators')
                         requested_datasets = list()
-                        for campaign in list(campaigns.keys()):
+                        for campaign in campaigns:
                             if campaign in TaskDefConstants.CAMPAIGNS_INTERCHANGEABLE[requested_campaign]:
                                 requested_datasets.extend(campaigns[campaign])
 
@@ -4954,12 +5040,12 @@ class TaskDefinition(object):
                     reuse_input = project_mode.reuseInput
 
             if use_default_splitting_rule and \
-                    (prod_step.lower() == 'evgen'.lower() or prod_step.lower() == 'simul'.lower()
+                    (prod_step.lower() in ('evgen', 'simul')
                      or force_merge_container):
                 return splitting_dict
 
             if project_mode.skipFilesUsedBy:
-                job_params = self.task_reg.get_task_parameter(project_mode.skipFilesUsedBy, 'jobParameters')
+                job_params = self._get_jedi_task_params_cached(int(project_mode.skipFilesUsedBy))['jobParameters']
                 primary_input = self._get_primary_input(job_params)
                 if primary_input:
                     splitting_dict[step.id] = list()
@@ -4969,14 +5055,15 @@ class TaskDefinition(object):
                                                     'container': None})
                     return splitting_dict
 
-            task_config = ProjectMode.get_task_config(step)
-            if 'previous_task_list' in list(task_config.keys()):
-                previous_task_list = ProductionTask.objects.filter(id__in=task_config['previous_task_list'])
-                for previous_task in previous_task_list:
-                    job_params = self.task_reg.get_task_parameter(previous_task.id, 'jobParameters')
+            if 'previous_task_list' in task_config:
+                previous_task_ids = list(ProductionTask.objects.filter(
+                    id__in=task_config['previous_task_list']).values_list('id', flat=True))
+                self._prefetch_jedi_task_params(previous_task_ids)
+                for previous_task_id in previous_task_ids:
+                    job_params = self._get_jedi_task_params_cached(previous_task_id)['jobParameters']
                     primary_input = self._get_primary_input(job_params)
                     if primary_input:
-                        if step.id not in list(splitting_dict.keys()):
+                        if step.id not in splitting_dict:
                             splitting_dict[step.id] = list()
                         splitting_dict[step.id].append({'dataset': primary_input['dataset'],
                                                         'offset': 0,
@@ -4987,13 +5074,13 @@ class TaskDefinition(object):
 
             if reuse_input and len(result['datasets']) == 1:
                 for i in range(reuse_input):
-                    if step.id not in list(splitting_dict.keys()):
+                    if step.id not in splitting_dict:
                         splitting_dict[step.id] = list()
                     splitting_dict[step.id].append({'dataset': result['datasets'][0], 'offset': 0,
                                                     'number_events': int(step.input_events), 'container': None})
                 return splitting_dict
 
-            if not self.rucio_client.is_dsn_container(input_data_name):
+            if not self._is_dsn_container_cached(input_data_name):
                 return splitting_dict
 
             use_real_events = True
@@ -5003,8 +5090,14 @@ class TaskDefinition(object):
             logger.info("Step = %d, container = %s, list of datasets = %s" %
                         (step.id, input_data_name, result['datasets']))
 
+            datasets_files_and_events = self.get_number_files_and_events_bulk(result['datasets'])
+            events_per_file_map = \
+                self.get_events_per_input_file_map(step, result['datasets'], use_real_events=use_real_events,
+                                                   datasets_files_and_events=datasets_files_and_events)
             number_events_in_container = \
-                self.get_events_in_datasets(result['datasets'], step, use_real_events=use_real_events)
+                self.get_events_in_datasets(result['datasets'], step, use_real_events=use_real_events,
+                                            datasets_files_and_events=datasets_files_and_events,
+                                            events_per_file_map=events_per_file_map)
             if not number_events_in_container:
                 raise Exception(
                     'Container {0} has no events or there is no information in AMI/Rucio'.format(input_data_name))
@@ -5035,21 +5128,21 @@ class TaskDefinition(object):
                     number_events_requested = number_events_available
                 else:
                     raise NotEnoughEvents(previous_existed_tasks)
-            if (step.input_events <= 0) and (step.request.request_type.lower() in ['GROUP'.lower()]):
-                processed_datasets = self._get_processed_datasets(step, result['datasets'])
+            if (step.input_events <= 0) and (request_type == 'group'):
+                processed_datasets = set(self._get_processed_datasets(step, result['datasets']))
                 for dataset_name in result['datasets']:
                     if dataset_name.split(':')[-1] not in processed_datasets:
-                        events_per_file = self.get_events_per_input_file(step, dataset_name,
-                                                                         use_real_events=use_real_events)
+                        number_files_and_events = \
+                            self._get_number_files_and_events(dataset_name, datasets_files_and_events)
+                        events_per_file = events_per_file_map[dataset_name]
                         if not events_per_file:
                             logger.info(
                                 "Step = %d, nEventsPerInputFile for dataset %s is missing, skipping this dataset" %
                                 (step.id, dataset_name))
                             return splitting_dict
-                        number_events = events_per_file * self.rucio_client.get_number_files(
-                            dataset_name)
+                        number_events = events_per_file * number_files_and_events[0]
                         if number_events:
-                            if step.id not in list(splitting_dict.keys()):
+                            if step.id not in splitting_dict:
                                 splitting_dict[step.id] = list()
                             splitting_dict[step.id].append({'dataset': dataset_name, 'offset': 0,
                                                             'number_events': number_events,
@@ -5057,54 +5150,50 @@ class TaskDefinition(object):
                 return splitting_dict
             start_offset = 0
             for dataset_name in result['datasets']:
-                offset = 0
-                number_events = 0
-                events_per_file = self.get_events_per_input_file(step, dataset_name, use_real_events=use_real_events)
+                if number_events_requested <= 0:
+                    # all events are requested
+                    break
+                number_files, number_events_in_rucio_dataset = \
+                    self._get_number_files_and_events(dataset_name, datasets_files_and_events)
+                events_per_file = events_per_file_map[dataset_name]
                 if not events_per_file:
                     logger.info("Step = %d, nEventsPerInputFile for dataset %s is missing, skipping this dataset" %
                                 (step.id, dataset_name))
                     return splitting_dict
-                number_events_in_dataset = events_per_file * self.rucio_client.get_number_files(dataset_name)
-                number_events_in_rucio_dataset = self.rucio_client.get_number_events(dataset_name)
+                number_events_in_dataset = events_per_file * number_files
                 if number_events_in_rucio_dataset > 0:
                     number_events_in_dataset = min(number_events_in_dataset, number_events_in_rucio_dataset)
-                try:
-                    if (start_offset + number_events_in_dataset) < number_events_processed:
-                        # skip dataset, all events are processed
-                        continue
-                    offset = number_events_processed - start_offset
-                    if number_events_requested > number_events_in_dataset - offset:
-                        number_events = number_events_in_dataset - offset
-                    else:
-                        number_events = number_events_requested
-                        # break, all events are requested
-                        break
-                finally:
+                if (start_offset + number_events_in_dataset) < number_events_processed:
+                    # skip dataset, all events are processed
                     start_offset += number_events_in_dataset
-                    number_events_requested -= number_events
-                    number_events_processed += number_events
-                    if number_events:
-                        if step.id not in list(splitting_dict.keys()):
-                            splitting_dict[step.id] = list()
-                        splitting_dict[step.id].append({'dataset': dataset_name,
-                                                        'offset': int(offset / events_per_file),
-                                                        'number_events': number_events,
-                                                        'container': input_data_name})
+                    continue
+                offset = number_events_processed - start_offset
+                number_events = min(number_events_requested, number_events_in_dataset - offset)
+                start_offset += number_events_in_dataset
+                number_events_requested -= number_events
+                number_events_processed += number_events
+                if number_events:
+                    if step.id not in splitting_dict:
+                        splitting_dict[step.id] = list()
+                    splitting_dict[step.id].append({'dataset': dataset_name,
+                                                    'offset': offset // events_per_file,
+                                                    'number_events': number_events,
+                                                    'container': input_data_name})
         return splitting_dict
 
     def _get_evgen_input_list(self, step, optimalFirstEvent = False):
         evgen_input_list = list()
         input_data_name = self.get_step_input_data_name(step)
         task_config = ProjectMode.get_task_config(step)
-        project_mode = ProjectMode(step)
+        project_mode = self._get_project_mode_cached(step)
         ctag_name = step.step_template.ctag
         ctag = self._get_ami_tag_cached(ctag_name)
         energy_gev = self._get_energy(step, ctag)
         input_params = self.get_input_params(step, step, False, energy_gev, False)
         container_name_key = None
         container_name = None
-        for key in list(input_params.keys()):
-            if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+        for key in input_params:
+            if _INPUT_FILE_PARAM_RE.match(key):
                 container_name_key = key
                 container_name = input_params[key][0]
                 break
@@ -5112,15 +5201,15 @@ class TaskDefinition(object):
         if not container_name:
             raise Exception('No input container found')
 
-        if 'nFilesPerJob' in list(input_params.keys()) and 'nFilesPerJob' not in list(task_config.keys()):
+        if 'nFilesPerJob' in input_params and 'nFilesPerJob' not in task_config:
             task_config.update({'nFilesPerJob': int(input_params['nFilesPerJob'])})
 
-        if 'previous_task_list' in list(task_config.keys()):
-            previous_task_list = ProductionTask.objects.filter(
-                id__in=task_config['previous_task_list'])
-            for previous_task in previous_task_list:
-                jedi_task = TTask.objects.get(id=previous_task.id)
-                task_params = json.loads(jedi_task.jedi_task_param)
+        if 'previous_task_list' in task_config:
+            previous_task_ids = list(ProductionTask.objects.filter(
+                id__in=task_config['previous_task_list']).values_list('id', flat=True))
+            self._prefetch_jedi_task_params(previous_task_ids)
+            for previous_task_id in previous_task_ids:
+                task_params = self._get_jedi_task_params_cached(previous_task_id)
                 job_params = task_params['jobParameters']
                 random_seed = self._get_job_parameter('randomSeed', job_params)
                 dsn = self._get_primary_input(job_params)['dataset'].split(':')[-1]
@@ -5135,19 +5224,20 @@ class TaskDefinition(object):
                 if not nfiles or not nfiles_per_job or not nevents_per_job:
                     raise Exception(
                         'Necessary task parameters are missing in the previous task')
-                input_params_split = copy.deepcopy(input_params)
-                input_params_split['nevents'] = math.ceil(float(nfiles * nevents_per_job) / float(nfiles_per_job))
+                input_params_split = _copy_evgen_input_params(input_params)
+                input_params_split['nevents'] = -(-nfiles * nevents_per_job // nfiles_per_job)
                 input_params_split['nfiles'] = nfiles
                 input_params_split['offset'] = offset
-                input_params_split['event_offset'] = int(offset * nevents_per_job / nfiles_per_job)
+                input_params_split['event_offset'] = offset * nevents_per_job // nfiles_per_job
                 input_params_split[container_name_key] = list([dsn])
                 evgen_input_list.append(input_params_split)
             return evgen_input_list
 
         datasets = self.rucio_client.list_datasets_in_container(container_name)
+        self._prefetch_number_files(datasets)
 
         nfiles_used = 0
-        task = None
+        task_id = None
         task_list = \
             ProductionTask.objects.filter(
                 ~Q(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']) &
@@ -5156,20 +5246,18 @@ class TaskDefinition(object):
                 project=step.request.project,
                 step__step_template__ctag=step.step_template.ctag).order_by(
                 '-id')
-        for previous_task in task_list:
-            requested_output_types = step.step_template.output_formats.split('.')
-            previous_output_types = previous_task.step.step_template.output_formats.split('.')
-            processed_output_types = [e for e in requested_output_types if e in previous_output_types]
-            if not processed_output_types:
+        requested_output_types = frozenset(step.step_template.output_formats.split('.'))
+        for previous_task_id, output_formats in \
+                task_list.values_list('id', 'step__step_template__output_formats').iterator(chunk_size=64):
+            if requested_output_types.isdisjoint(output_formats.split('.')):
                 continue
-            task = previous_task
+            task_id = previous_task_id
             break
 
         task_dsn_no_scope = None
 
-        if task:
-            jedi_task = TTask.objects.get(id=task.id)
-            task_params = json.loads(jedi_task.jedi_task_param)
+        if task_id:
+            task_params = self._get_jedi_task_params_cached(task_id)
             task_random_seed = \
                 self._get_job_parameter('randomSeed', task_params['jobParameters'])
             task_dsn_no_scope = \
@@ -5183,14 +5271,14 @@ class TaskDefinition(object):
             if 'nFiles' in task_params:
                 nfiles_in_tid_ds = 0
                 if 'tid' in task_dsn_no_scope:
-                    nfiles_in_tid_ds = self.rucio_client.get_number_files_from_metadata(task_dsn_no_scope)
+                    nfiles_in_tid_ds = self._get_number_files_cached(task_dsn_no_scope)
                 nfiles_used += max([int(task_params['nFiles']), nfiles_in_tid_ds])
 
         if project_mode.splitEvgenOffsetByLast:
             total_files = 0
             for dsn in datasets:
                 tid_dsn_no_scope = dsn.split(':')[-1]
-                nfiles_in_tid_ds = self.rucio_client.get_number_files_from_metadata(dsn)
+                nfiles_in_tid_ds = self._get_number_files_cached(dsn)
                 total_files += nfiles_in_tid_ds
                 if tid_dsn_no_scope == task_dsn_no_scope:
                     nfiles_used = max([total_files, nfiles_used])
@@ -5204,14 +5292,14 @@ class TaskDefinition(object):
                 'The task is rejected')
         nfiles_per_job = task_config.get('nFilesPerJob', 1)
 
-        nfiles_requested = math.ceil(int(step.input_events) * nfiles_per_job / nevents_per_job)
+        nfiles_requested = -(-int(step.input_events) * nfiles_per_job // nevents_per_job)
         nfiles = 0
         files_used_count = nfiles_used
         files_requested_count = nfiles_requested
 
         for dsn in datasets:
             dsn_no_scope = dsn.split(':')[-1]
-            nfiles_in_ds = self.rucio_client.get_number_files_from_metadata(dsn)
+            nfiles_in_ds = self._get_number_files_cached(dsn)
             files_used_count -= nfiles_in_ds
             if files_used_count >= 0:
                 continue
@@ -5219,31 +5307,28 @@ class TaskDefinition(object):
                 continue
             if dsn_no_scope == task_dsn_no_scope:
                 continue
-            input_params_split = copy.deepcopy(input_params)
+            input_params_split = _copy_evgen_input_params(input_params)
             files_requested_count -= nfiles_in_ds
             if files_requested_count > 0:
-                input_params_split['nevents'] = math.ceil(nfiles_in_ds * nevents_per_job // nfiles_per_job)
+                input_params_split['nevents'] = nfiles_in_ds * nevents_per_job // nfiles_per_job
                 input_params_split['nfiles'] = nfiles_in_ds
                 input_params_split['offset'] = nfiles_used + nfiles
-                input_params_split['event_offset'] = \
-                    math.ceil(input_params_split['offset'] * nevents_per_job )
+                input_params_split['event_offset'] = input_params_split['offset'] * nevents_per_job
                 if optimalFirstEvent:
                     input_params_split.pop('event_offset')
-                    input_params_split['offset'] = math.ceil((nfiles_used + nfiles)/nfiles_per_job)
+                    input_params_split['offset'] = -(-(nfiles_used + nfiles) // nfiles_per_job)
                 input_params_split[container_name_key] = list([dsn])
                 evgen_input_list.append(input_params_split)
                 nfiles += nfiles_in_ds
 
             else:
-                input_params_split['nevents'] = \
-                    math.ceil((nfiles_requested - nfiles) * nevents_per_job // nfiles_per_job)
+                input_params_split['nevents'] = (nfiles_requested - nfiles) * nevents_per_job // nfiles_per_job
                 input_params_split['nfiles'] = (nfiles_requested - nfiles)
                 input_params_split['offset'] = nfiles_used + nfiles
-                input_params_split['event_offset'] = \
-                    math.ceil(input_params_split['offset'] * nevents_per_job )
+                input_params_split['event_offset'] = input_params_split['offset'] * nevents_per_job
                 if optimalFirstEvent:
                     input_params_split.pop('event_offset')
-                    input_params_split['offset'] = math.ceil((nfiles_used + nfiles)/nfiles_per_job)
+                    input_params_split['offset'] = -(-(nfiles_used + nfiles) // nfiles_per_job)
                 input_params_split[container_name_key] = list([dsn])
                 evgen_input_list.append(input_params_split)
                 nfiles += (nfiles_requested - nfiles)
@@ -5259,11 +5344,12 @@ class TaskDefinition(object):
             )
         return evgen_input_list
 
-    def _build_linked_step_list(self, req, input_slice):
+    def _build_linked_step_list(self, req, input_slice, step_list=None):
         # Approved
-        step_list = list(StepExecution.objects.filter(request=req,
-                                                      status=self.protocol.STEP_STATUS[StepStatus.APPROVED],
-                                                      slice=input_slice))
+        if step_list is None:
+            step_list = list(StepExecution.objects.filter(request=req,
+                                                          status=self.protocol.STEP_STATUS[StepStatus.APPROVED],
+                                                          slice=input_slice))
         result_list = []
         temporary_list = []
         another_chain_step = None
@@ -5276,20 +5362,23 @@ class TaskDefinition(object):
             else:
                 temporary_list.append(step)
         if not result_list:
+            step_parents = StepExecution.objects.in_bulk({step.step_parent_id for step in temporary_list})
             for index, current_step in enumerate(temporary_list):
-                step_parent = StepExecution.objects.get(id=current_step.step_parent_id)
+                step_parent = step_parents[current_step.step_parent_id]
                 if step_parent not in temporary_list:
                     # step in other chain
                     another_chain_step = step_parent
                     result_list.append(current_step)
                     temporary_list.pop(index)
+        # parent step id -> the first child step
+        child_steps = dict()
+        for step in temporary_list:
+            child_steps.setdefault(step.step_parent_id, step)
         for i in range(len(temporary_list)):
-            j = 0
-            while temporary_list[j].step_parent_id != result_list[-1].id:
-                j += 1
-                if j >= len(temporary_list):
-                    raise ValueError('Not linked chain')
-            result_list.append(temporary_list[j])
+            child_step = child_steps.get(result_list[-1].id)
+            if child_step is None:
+                raise ValueError('Not linked chain')
+            result_list.append(child_step)
         return result_list, another_chain_step
 
     @staticmethod
@@ -5298,7 +5387,8 @@ class TaskDefinition(object):
             return 'test'
         if keep_approved:
             return 'approved'
-        statuses = TRequestStatus.objects.filter(request=request).order_by('-timestamp')
+        statuses = list(TRequestStatus.objects.filter(request=request).only(
+            'status', 'timestamp', 'owner', 'comment').order_by('-timestamp'))
         if statuses[0].timestamp > locked_time and statuses[0].status == 'approved' and current_status == 'approved':
             return 'approved'
         number_of_repeated_attempts = 0
@@ -5355,42 +5445,56 @@ class TaskDefinition(object):
             self.template_results[step.id] = task_template
 
     def _define_tasks_for_requests(self, requests, jira_client, restart=False, template_type=None):
+        TRequest.objects.filter(id__in=[request.id for request in requests]).update(locked=True)
         for request in requests:
             request.locked = True
-            request.save()
-            logger.info("Request %d is locked" % request.id)
+            logger.info("Request %d is locked", request.id)
         self.lock_request_time = timezone.now()
         logger.info("Processing production requests")
-        logger.info("Requests to process: %s" % str([int(req.id) for req in requests]))
+        logger.info("Requests to process: %s", [int(req.id) for req in requests])
         self.template_type = template_type
         if self.template_type:
             self.template_results = {}
+        step_status_approved = self.protocol.STEP_STATUS[StepStatus.APPROVED].lower()
+        step_status_notchecked = self.protocol.STEP_STATUS[StepStatus.NOTCHECKED].lower()
+        request_status_approved = self.protocol.REQUEST_STATUS[RequestStatus.APPROVED].lower()
         keep_approved = False
         for request in requests:
             try:
-                logger.info("Processing request %d" % request.id)
+                logger.info("Processing request %d", request.id)
                 exception = False
                 summary_log = ''
                 processed_slices = []
                 first_steps = list()
-                for input_slice in InputRequestList.objects.filter(request=request).order_by('slice'):
-                    steps_in_slice = StepExecution.objects.filter(request=request,
-                                                                  status=self.protocol.STEP_STATUS[StepStatus.APPROVED],
-                                                                  slice=input_slice).order_by('id')
+                slice_steps = list()
+                for input_slice in InputRequestList.objects.filter(request=request).only('id', 'slice').order_by(
+                        'slice'):
+                    steps_in_slice = list(StepExecution.objects.filter(request=request,
+                                                                       status=self.protocol.STEP_STATUS[StepStatus.APPROVED],
+                                                                       slice=input_slice).order_by('id'))
                     try:
-                        steps_in_slice, _ = self._build_linked_step_list(request, input_slice)
+                        steps_in_slice, _ = self._build_linked_step_list(request, input_slice, steps_in_slice)
                     except Exception as ex:
-                        logger.exception("_build_linked_step_list failed: %s" % str(ex))
+                        logger.exception("_build_linked_step_list failed: %s", ex)
 
                     if steps_in_slice:
-                        for step in steps_in_slice:
-                            if not self.task_reg.get_step_output(step.id, exclude_failed=False) or restart:
-                                first_steps.append(step)
-                                break
-                logger.info("Request = %d, chains: %s" % (request.id, str([int(st.id) for st in first_steps])))
+                        slice_steps.append(steps_in_slice)
+                if restart:
+                    step_outputs = dict()
+                else:
+                    step_outputs = self.task_reg.get_step_outputs_bulk(
+                        [step.id for steps_in_slice in slice_steps for step in steps_in_slice], exclude_failed=False)
+                for steps_in_slice in slice_steps:
+                    for step in steps_in_slice:
+                        if not step_outputs.get(step.id) or restart:
+                            first_steps.append(step)
+                            break
+                logger.info("Request = %d, chains: %s", request.id, [int(st.id) for st in first_steps])
                 TaskRegistration.register_request_reference(request)
+                step_parents = StepExecution.objects.select_related('request', 'slice').in_bulk(
+                    {step.step_parent_id for step in first_steps})
                 for step in first_steps:
-                    step_parent = StepExecution.objects.get(id=step.step_parent_id)
+                    step_parent = step_parents[step.step_parent_id]
                     if step_parent.status == self.protocol.STEP_STATUS[StepStatus.WAITING]:
                         continue
                     try:
@@ -5404,7 +5508,7 @@ class TaskDefinition(object):
                         if input_data_name.startswith('ami#'):
                             ami_hashtag_input = input_data_name.split('ami#')[-1]
                             if ami_hashtag_input:
-                                logger.info('AMI # "{0}" is used as input'.format(ami_hashtag_input))
+                                logger.info('AMI # "%s" is used as input', ami_hashtag_input)
                                 ami_hashtag_input_list = self.ami_client.list_containers_for_hashtag(
                                     ami_hashtag_input.split(':')[0], ami_hashtag_input.split(':')[-1]
                                 )
@@ -5422,18 +5526,19 @@ class TaskDefinition(object):
                                 else:
                                     raise e
                             if input_data_dict:
-                                force_split_evgen = ProjectMode(step).splitEvgen
+                                force_split_evgen = self._get_project_mode_cached(step).splitEvgen
 
-                                if str(input_data_dict['number']).lower().startswith('period'.lower()) \
-                                        or input_data_dict['prod_step'].lower() == 'PhysCont'.lower():
+                                prod_step = input_data_dict['prod_step'].lower()
+                                if str(input_data_dict['number']).lower().startswith('period') \
+                                        or prod_step == 'physcont':
                                     input_params = self.get_input_params(step, step, None, 0, False)
                                     if not input_params:
                                         raise Exception("No datasets in the period container %s" % input_data_name)
-                                    for key in list(input_params.keys()):
-                                        if re.match(r'^(--)?input.*File$', key, re.IGNORECASE):
+                                    for key in input_params:
+                                        if _INPUT_FILE_PARAM_RE.match(key):
                                             phys_cont_list.extend(input_params[key])
-                                elif input_data_dict['prod_step'].lower() == 'py'.lower() and force_split_evgen:
-                                    evgen_input_list.extend(self._get_evgen_input_list(step, ProjectMode(step).optimalFirstEvent))
+                                elif prod_step == 'py' and force_split_evgen:
+                                    evgen_input_list.extend(self._get_evgen_input_list(step, self._get_project_mode_cached(step).optimalFirstEvent))
                         if phys_cont_list:
                             for input_dataset in phys_cont_list:
                                 try:
@@ -5498,22 +5603,21 @@ class TaskDefinition(object):
                         else:
                             use_parent_output = None
                             if step.id != step.step_parent_id:
-                                parent_step = StepExecution.objects.get(id=step.step_parent_id)
-                                if parent_step.status.lower() == self.protocol.STEP_STATUS[StepStatus.APPROVED].lower():
+                                parent_step = step_parent
+                                parent_step_status = parent_step.status.lower()
+                                if parent_step_status == step_status_approved:
                                     use_parent_output = True
-                                    if parent_step.request.status.lower() == \
-                                            self.protocol.REQUEST_STATUS[RequestStatus.APPROVED].lower()\
+                                    if parent_step.request.status.lower() == request_status_approved \
                                             and parent_step.request != step.request:
                                         keep_approved = True
-                                elif parent_step.status.lower() == \
-                                        self.protocol.STEP_STATUS[StepStatus.NOTCHECKED].lower():
+                                elif parent_step_status == step_status_notchecked:
                                     raise Exception("Parent step is '{0}'".format(parent_step.status))
                             splitting_dict = dict()
                             try:
                                 if not use_parent_output:
                                     splitting_dict = self._get_splitting_dict(step)
                                 elif type(step.input_events) is int and step.input_events > -1:
-                                    parent_step = StepExecution.objects.get(id=step.step_parent_id)
+                                    parent_step = step_parent
                                     if step.input_events < parent_step.slice.input_events:
                                         raise InputEventsForChildStepException()
                             except NotEnoughEvents:
@@ -5526,9 +5630,9 @@ class TaskDefinition(object):
                                 raise Exception('No input for specified campaign')
                             except Exception:
                                 raise
-                            if step.id not in list(splitting_dict.keys()):
+                            if step.id not in splitting_dict:
                                 if use_parent_output:
-                                    parent_step = StepExecution.objects.get(id=step.step_parent_id)
+                                    parent_step = step_parent
                                     for task_id in self.task_reg.get_step_tasks(parent_step.id):
                                         try:
                                             self.create_task_chain(step.id, restart=use_parent_output,
@@ -5605,12 +5709,12 @@ class TaskDefinition(object):
                             break
                 request.exception = exception
                 request.save()
-                logger.info("Request = %d, status = %s" % (request.id, request.status))
+                logger.info("Request = %d, status = %s", request.id, request.status)
             finally:
                 # unlock request
                 request.locked = False
-                request.save()
-                logger.info("Request %s is unlocked" % request.id)
+                request.save(update_fields=['locked'])
+                logger.info("Request %s is unlocked", request.id)
 
     def force_process_requests(self, requests_ids, restart=False):
         jira_client = JIRAClient()
@@ -5646,23 +5750,28 @@ class TaskDefinition(object):
                                                description__contains='_debug',
                                                id__gt=800,
                                                status=request_status).order_by('id')
-        if request_types and requests:
+        if request_types:
             requests = requests.filter(request_type__in=request_types)
-        if len(requests) == 0:
+        # only the id and the fast flag are needed to choose the request to process
+        polled_requests = list(requests.values_list('id', 'is_fast'))
+        if not polled_requests:
             return
-        ready_request_list = list()
-        for request in requests:
-            is_fast = request.is_fast or False
-            last_access_timestamp = \
-                TRequestStatus.objects.filter(request=request, status=request_status).order_by('-id')[0].timestamp
+        last_access_timestamps = dict(
+            TRequestStatus.objects.filter(request_id__in=[request_id for request_id, _ in polled_requests],
+                                          status=request_status).values(
+                'request_id').annotate(timestamp=Max('timestamp')).values_list('request_id', 'timestamp'))
+        ready_request_ids = list()
+        for request_id, is_fast in polled_requests:
+            is_fast = is_fast or False
+            last_access_timestamp = last_access_timestamps[request_id]
             now = timezone.now()
             time_offset = (now - last_access_timestamp).seconds
             if (time_offset // 3600) < REQUEST_GRACE_PERIOD:
                 if (not no_wait) and (not is_fast):
-                    logger.info("Request %d is skipped, approved at %s" % (request.id, last_access_timestamp))
+                    logger.info("Request %d is skipped, approved at %s", request_id, last_access_timestamp)
                     continue
-            ready_request_list.append(request)
-        requests = ready_request_list[:1]
+            ready_request_ids.append(request_id)
+        requests = list(TRequest.objects.filter(id__in=ready_request_ids[:1]))
         self._define_tasks_for_requests(requests, jira_client, restart)
 
     def _check_evgen_hepmc(self, trf_cache, trf_release, campaign):
@@ -2,17 +2,45 @@ __author__ = 'Dmitry Golubkov'
 
 import json
 import re
+import threading
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import router, transaction
+from django.db.models import Max
 from taskengine.models import ProductionDataset, ProductionTask, TTask, StepExecution, HashTag, HashTagToRequest, TaskTemplate
 from taskengine.protocol import Protocol, TaskStatus, TaskDefConstants
 from django.utils import timezone
-from deftcore.settings import MONITORING_REQUEST_LINK_FORMAT
+from deftcore.settings import MONITORING_REQUEST_LINK_FORMAT, BULK_CREATE_BATCH_SIZE
 from deftcore.jira import JIRAClient
 from deftcore.log import Logger
 from taskengine.rucioclient import RucioClient
 
 logger = Logger.get()
 
+_PRIMARY_INPUT_PARAM_RE = re.compile(r'^(--)?input(?P<intype>.*)File', re.IGNORECASE)
+_BACKGROUND_INPUT_TYPE_RE = re.compile(r'PtMinbias|Cavern', re.IGNORECASE)
+_FAILED_TASK_STATUSES = ('failed', 'broken', 'aborted', 'obsolete', 'toabort')
+
+# Protocol keeps no state, one instance serves all registrations
+_PROTOCOL = Protocol()
+_TASK_STATUS_WAITING = _PROTOCOL.TASK_STATUS[TaskStatus.WAITING]
+
+# authorized JIRA client shared by request reference registrations of the process
+_jira_client = None
+_jira_client_lock = threading.Lock()
+# serializes creation of request tickets, so a request never gets two of them
+_request_reference_lock = threading.Lock()
+
+
+def _get_jira_client():
+    global _jira_client
+    if _jira_client is None:
+        with _jira_client_lock:
+            if _jira_client is None:
+                client = JIRAClient()
+                client.authorize()
+                _jira_client = client
+    return _jira_client
+
 
 # noinspection PyUnresolvedReferences
 class TaskRegistration(object):
@@ -20,25 +48,36 @@ class TaskRegistration(object):
     def register_task_id():
         return TTask().get_id()
 
+    @staticmethod
+    def register_task_ids(count):
+        if count <= 0:
+            return list()
+        return TTask().get_ids(count)
+
     def register_task_output(self, output_params, task_proto_id, task_id, parent_task_id, usergroup, campaign):
-        for key in list(output_params.keys()):
-            for output_dataset_name in output_params[key]:
-                output_dataset_name = output_dataset_name.replace(
-                    TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id,
-                    TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id)
-                if ProductionDataset.objects.filter(name=output_dataset_name).exists():
-                    continue
-                else:
-                    dataset = ProductionDataset(name=output_dataset_name,
-                                                task_id=task_id,
-                                                parent_task_id=parent_task_id,
-                                                phys_group=usergroup,
-                                                timestamp=timezone.now(),
-                                                campaign=campaign)
-
-                    dataset.save()
-
-                    logger.debug('Dataset {0} is registered'.format(output_dataset_name))
+        task_proto_id_string = TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_proto_id
+        task_id_string = TaskDefConstants.DEFAULT_TASK_ID_FORMAT % task_id
+        # ordered and without duplicates
+        output_dataset_names = list(dict.fromkeys(
+            output_dataset_name.replace(task_proto_id_string, task_id_string)
+            for output_dataset_names_by_type in output_params.values()
+            for output_dataset_name in output_dataset_names_by_type))
+        registered_names = set(
+            ProductionDataset.objects.filter(name__in=output_dataset_names).values_list('name', flat=True))
+        timestamp = timezone.now()
+        datasets = [ProductionDataset(name=output_dataset_name,
+                                      task_id=task_id,
+                                      parent_task_id=parent_task_id,
+                                      phys_group=usergroup,
+                                      timestamp=timestamp,
+                                      campaign=campaign)
+                    for output_dataset_name in output_dataset_names if output_dataset_name not in registered_names]
+        if not datasets:
+            return
+        with transaction.atomic(using=router.db_for_write(ProductionDataset)):
+            ProductionDataset.objects.bulk_create(datasets, batch_size=BULK_CREATE_BATCH_SIZE)
+
+        logger.debug('Datasets {0} are registered'.format(', '.join(dataset.name for dataset in datasets)))
 
     @staticmethod
     def _register_task_reference(step):
@@ -47,7 +86,14 @@ class TaskRegistration(object):
     @staticmethod
     def register_request_reference(request):
         try:
-            if not request.reference:
+            if request.reference:
+                return request.reference
+            with _request_reference_lock:
+                # the reference may have been registered meanwhile by another thread or process
+                request.refresh_from_db(fields=['reference'])
+                if request.reference:
+                    return request.reference
+
                 link_to_request = MONITORING_REQUEST_LINK_FORMAT % request.id
 
                 ticket_summary = 'Request {0}'.format(request.id)
@@ -57,25 +103,23 @@ class TaskRegistration(object):
                     'Manager: {0}\nLink to the request: {1}'.format(
                         request.manager, link_to_request)
 
-                client = JIRAClient()
-                client.authorize()
-
-                issue_key = client.create_issue(ticket_summary, ticket_description)
+                issue_key = _get_jira_client().create_issue(ticket_summary, ticket_description)
 
                 request.reference = issue_key
-                request.save()
+                request.save(update_fields=['reference'])
             return request.reference
         except Exception as ex:
             logger.exception('register_request_reference, exception occurred: {0}'.format(str(ex)))
             return None
 
     def register_task_template(self, task, step, parent_task_id, template_type=None, template_build=None):
-        protocol = Protocol()
+        protocol = _PROTOCOL
         if TaskTemplate.objects.filter(step=step,request=step.request, template_type=template_type,build=template_build).exists():
             task_template = TaskTemplate.objects.get(step=step,request=step.request, template_type=template_type,build=template_build)
             task_template.name = task['taskName']
             task_template.task_error = None
             task_template.task_template = protocol.serialize_task(task)
+            task_template.save(update_fields=['name', 'task_error', 'task_template', 'timestamp'])
         else:
             task_template = TaskTemplate(step=step,
                                          request=step.request,
@@ -84,7 +128,7 @@ class TaskRegistration(object):
                                          template_type=template_type,
                                          task_template=protocol.serialize_task(task),
                                          build=template_build)
-        task_template.save()
+            task_template.save()
         return   task_template
 
 
@@ -95,27 +139,22 @@ class TaskRegistration(object):
     def register_task(self, task, step, task_id, parent_task_id, chain_id, project, input_data_name, number_of_events,
                       campaign, subcampaign, bunchspacing, ttcr_timestamp, truncate_output_formats=None,
                       task_common_offset=None):
-        protocol = Protocol()
+        # step is expected to come with its request and step template loaded (select_related)
+        protocol = _PROTOCOL
 
         issue_key = self._register_task_reference(step)
         task['ticketID'] = issue_key
 
         # FIXME
-        is_extension = False
-        try:
-            for param in task['jobParameters']:
-                if 'offset' in list(param.keys()):
-                    if param['offset'] != 0:
-                        is_extension = True
-                        break
-        except Exception as ex:
-            logger.exception('register_task, checking offset failed: {0}'.format(str(ex)))
+        is_extension = any(param.get('offset', 0) != 0 for param in task.get('jobParameters', ()))
+
+        timestamp = timezone.now()
 
         jedi_task = TTask(id=task_id,
                           parent_tid=parent_task_id,
-                          status=protocol.TASK_STATUS[TaskStatus.WAITING],
+                          status=_TASK_STATUS_WAITING,
                           total_done_jobs=0,
-                          submit_time=timezone.now(),
+                          submit_time=timestamp,
                           vo=task['vo'],
                           prodSourceLabel=task['prodSourceLabel'],
                           taskname=task['taskName'],
@@ -127,34 +166,40 @@ class TaskRegistration(object):
         if number_of_events > 0:
             total_req_events = number_of_events
 
-        output_formats = step.step_template.output_formats
+        step_template = step.step_template
+        output_formats = step_template.output_formats
         if truncate_output_formats:
             output_format_list = output_formats.split('.')
             output_formats_truncated_list = list()
+            max_length = ProductionTask._meta.get_field('output_formats').max_length
+            # length of the joined list, separators included
+            truncated_length = -1
             for output_format in output_format_list:
-                max_length = ProductionTask._meta.get_field('output_formats').max_length
-                if len('.'.join(output_formats_truncated_list + [output_format, ])) > max_length:
+                truncated_length += len(output_format) + 1
+                if truncated_length > max_length:
                     break
                 output_formats_truncated_list.append(output_format)
             output_formats = '.'.join(output_formats_truncated_list)
 
+        provenance, phys_group = task['workingGroup'].split('_', 2)[:2]
+
         prod_task = ProductionTask(id=task_id,
                                    step_id=step.id,
-                                   request_id=step.request.id,
+                                   request_id=step.request_id,
                                    parent_id=parent_task_id,
                                    name=task['taskName'],
                                    project=project,
-                                   phys_group=task['workingGroup'].split('_')[1],
-                                   provenance=task['workingGroup'].split('_')[0],
+                                   phys_group=phys_group,
+                                   provenance=provenance,
                                    status='waiting',
                                    total_events=0,
                                    total_req_jobs=0,
                                    total_done_jobs=0,
-                                   submit_time=timezone.now(),
+                                   submit_time=timestamp,
                                    bug_report=0,
                                    priority=task['taskPriority'],
                                    inputdataset=input_data_name,
-                                   timestamp=timezone.now(),
+                                   timestamp=timestamp,
                                    vo=task['vo'],
                                    prodSourceLabel=task['prodSourceLabel'],
                                    username=task['userName'],
@@ -169,14 +214,15 @@ class TaskRegistration(object):
                                    is_extension=is_extension,
                                    ttcr_timestamp=ttcr_timestamp,
                                    primary_input=self.get_primary_input(task),
-                                   ctag=step.step_template.ctag,
+                                   ctag=step_template.ctag,
                                    output_formats=output_formats)
 
         if issue_key:
             prod_task.reference = issue_key
 
-        prod_task.save()
-        jedi_task.save()
+        with transaction.atomic(using=router.db_for_write(ProductionTask)):
+            prod_task.save()
+            jedi_task.save()
 
         if task_common_offset:
             task_common_offset_hashtag = TaskDefConstants.DEFAULT_TASK_COMMON_OFFSET_HASHTAG_FORMAT.format(
@@ -200,37 +246,40 @@ class TaskRegistration(object):
         pass
 
     def get_step_output(self, step_id, exclude_failed=True, task_id=None):
-        try:
-            step = StepExecution.objects.get(id=step_id)
-        except ObjectDoesNotExist:
+        if not StepExecution.objects.filter(id=step_id).exists():
             logger.debug('get_step_output, step {0} is not found'.format(step_id))
             return list()
         if task_id:
             tasks = ProductionTask.objects.filter(id=task_id)
         else:
-            tasks = ProductionTask.objects.filter(step=step).order_by('-id')
+            tasks = ProductionTask.objects.filter(step_id=step_id).order_by('-id')
         if exclude_failed:
-            tasks = tasks.exclude(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort'])
-        if len(tasks) == 0:
+            tasks = tasks.exclude(status__in=_FAILED_TASK_STATUSES)
+        last_task_id = tasks.values_list('id', flat=True).first()
+        if last_task_id is None:
             return list()
-        dataset_name_list = [dataset.name for dataset in ProductionDataset.objects.filter(task_id=tasks[0].id)]
-        return dataset_name_list
+        return list(ProductionDataset.objects.filter(task_id=last_task_id).values_list('name', flat=True))
+
+    def get_step_outputs_bulk(self, step_ids, exclude_failed=True):
+        tasks = ProductionTask.objects.filter(step_id__in=step_ids)
+        if exclude_failed:
+            tasks = tasks.exclude(status__in=_FAILED_TASK_STATUSES)
+        # the output of a step is the output of its last task
+        last_task_ids = dict(tasks.values('step_id').annotate(last_task_id=Max('id')).values_list(
+            'step_id', 'last_task_id'))
+        task_ids_with_output = set(ProductionDataset.objects.filter(
+            task_id__in=list(last_task_ids.values())).values_list('task_id', flat=True).distinct())
+        return {step_id: last_task_ids.get(step_id) in task_ids_with_output for step_id in step_ids}
 
     def get_step_tasks(self, step_id, exclude_failed=True):
-        try:
-            step = StepExecution.objects.get(id=step_id)
-        except ObjectDoesNotExist:
-            return list()
-        tasks = ProductionTask.objects.filter(step=step).order_by('id')
+        tasks = ProductionTask.objects.filter(step_id=step_id).order_by('id')
         if exclude_failed:
-            tasks = tasks.exclude(status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort'])
-        if len(tasks) == 0:
-            return list()
-        return [task.id for task in tasks]
+            tasks = tasks.exclude(status__in=_FAILED_TASK_STATUSES)
+        return list(tasks.values_list('id', flat=True))
 
     def get_task_parameter(self, task_id, param_name):
         try:
-            task = TTask.objects.get(id=task_id)
+            task = TTask.objects.only('id', 'jedi_task_param').get(id=task_id)
         except ObjectDoesNotExist:
             logger.debug('get_task_parameter, task {0} is not found'.format(task_id))
             return None
@@ -241,44 +290,39 @@ class TaskRegistration(object):
             return task_id
         parent_tasks = \
             ProductionTask.objects.filter(step=step.step_parent_id).exclude(
-                status__in=['failed', 'broken', 'aborted', 'obsolete', 'toabort']).order_by('-id')
-        if len(parent_tasks) == 0:
+                status__in=_FAILED_TASK_STATUSES).order_by('-id')
+        parent_task_id = parent_tasks.values_list('id', flat=True).first()
+        if parent_task_id is None:
             return task_id
-        return parent_tasks[0].id
+        return parent_task_id
 
     def get_dataset_task_id(self, dataset_name):
-        try:
-            dataset = ProductionDataset.objects.get(name=dataset_name)
-            return dataset.task_id
-        except ObjectDoesNotExist:
-            return None
+        return ProductionDataset.objects.filter(name=dataset_name).values_list('task_id', flat=True).first()
 
     def get_primary_input(self, task):
         job_parameters = task['jobParameters']
         primary_input_param = None
         primary_input_dsn = None
         for job_param in job_parameters:
-            if 'param_type' not in list(job_param.keys()) or job_param['param_type'].lower() != 'input'.lower():
+            if job_param.get('param_type', '').lower() != 'input':
+                continue
+            result = _PRIMARY_INPUT_PARAM_RE.match(job_param['value'])
+            if not result:
+                continue
+            in_type = result.group('intype')
+            if in_type.lower() == 'logs' or \
+                    _BACKGROUND_INPUT_TYPE_RE.search(in_type) or \
+                    in_type.lower() == 'ZeroBiasBS':
                 continue
-            if re.match(r'^(--)?input.*File', job_param['value'], re.IGNORECASE):
-                result = re.match(r'^(--)?input(?P<intype>.*)File', job_param['value'], re.IGNORECASE)
-                if not result:
-                    continue
-                in_type = result.groupdict()['intype']
-                if in_type.lower() == 'logs'.lower() or \
-                        re.match(r'^.*(PtMinbias|Cavern).*$', in_type, re.IGNORECASE) or \
-                        in_type.lower() == 'ZeroBiasBS':
-                    continue
-                primary_input_param = job_param
-                break
+            primary_input_param = job_param
+            break
         if primary_input_param:
-            primary_input_dsn = str(primary_input_param['dataset']).split('/')[0].split(':')[-1]
+            primary_input_dsn = str(primary_input_param['dataset']).partition('/')[0].rpartition(':')[2]
         return primary_input_dsn
 
     @staticmethod
     def check_task_output(task_id, types):
-        output_datasets = \
-            [dataset.name for dataset in ProductionDataset.objects.filter(task_id=task_id)]
+        output_datasets = list(ProductionDataset.objects.filter(task_id=task_id).values_list('name', flat=True))
 
         rucio_client = RucioClient()
 